@@ -0,0 +1,374 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+# Round trips through main.py on synthetic data, timed stage by stage with main.py's --stats output.
+# Everything runs in throwaway folders with a throwaway, passphrase-less vault key, so the real
+# keys/, vault/ and registry are never touched.
+
+BENCH_DIR = Path(__file__).resolve().parent
+MAIN = BENCH_DIR.parent / "main.py"
+CORPUS_DIR = BENCH_DIR / "corpus"
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+
+# Same user ID main.py looks for, so it picks up the key made here instead of generating its own
+VAULT_KEY_NAME = "Secret Archive Vault Key"
+
+CORPORA = ["random", "text", "compressed", "tree"]
+METHODS = ["gzip", "lzma", "store", "auto"]
+PIECE_SIZE = 1024 * 1024
+# Runs faster than this are mostly noise, so they never count as regressions
+MIN_SECONDS = 0.05
+
+WORDS = ("the of and to in is that for it as was with be by on not he this are or his from at which but have an "
+         "they you were her she there one all we their been has would when if so no what can said who will more "
+         "archive vault key file folder block chunk stream cipher registry compress encrypt restore entry index "
+         "0 1 2 3 4 5 6 7 8 9 10 42 100 2024 1.5 3.14").split()
+
+
+class bcolors:
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def parsesize(size):
+    # "64K", "16M", "2G" or plain bytes
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def sizename(size):
+    for unit, factor in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if size >= factor and size % factor == 0:
+            return str(size // factor) + unit
+    return str(size)
+
+
+def textpiece(rng, size):
+    # Word salad with punctuation and line breaks, which compresses about as well as real prose
+    words = rng.choices(WORDS, k=size // 4)
+    text = " ".join(words).encode("ascii")
+    return text.replace(b" the ", b".\nThe ")[:size]
+
+
+def randompiece(rng, size):
+    return rng.randbytes(size)
+
+
+def compressedpiece(rng, size):
+    # Already compressed data, like the media and archives people keep in a vault
+    data = b""
+    while len(data) < size:
+        data += zlib.compress(textpiece(rng, 4 * PIECE_SIZE), 6)
+    return data[:size]
+
+
+def writecorpusfile(path, size, piece, rng):
+    with open(path, "wb") as f_out:
+        written = 0
+        while written < size:
+            data = piece(rng, min(PIECE_SIZE, size - written))
+            f_out.write(data)
+            written += len(data)
+
+
+def makecorpus(kind, size):
+    # Generate a corpus once and keep it in CORPUS_DIR. The same kind and size always gives the same bytes.
+    name = kind + "-" + sizename(size)
+    path = CORPUS_DIR / name
+    if path.exists():
+        return path
+    CORPUS_DIR.mkdir(exist_ok=True)
+    rng = random.Random(name)
+    temppath = CORPUS_DIR / (name + ".tmp")
+    shutil.rmtree(temppath, ignore_errors=True)
+    if kind == "tree":
+        # Lots of small files a few folders deep, mostly text with some incompressible ones mixed in
+        temppath.mkdir()
+        written = 0
+        number = 0
+        while written < size:
+            folder = temppath / ("dir" + str(number % 7)) / ("sub" + str(number % 3))
+            folder.mkdir(parents=True, exist_ok=True)
+            length = min(rng.randint(512, 32 * 1024), size - written)
+            piece = randompiece if number % 5 == 0 else textpiece
+            writecorpusfile(folder / ("file" + str(number) + ".txt"), length, piece, rng)
+            written += length
+            number += 1
+    else:
+        piece = {"random": randompiece, "text": textpiece, "compressed": compressedpiece}[kind]
+        writecorpusfile(temppath, size, piece, rng)
+    os.replace(temppath, path)
+    return path
+
+
+def treedigest(path):
+    # Hash of a file, or of the names and contents of everything in a folder
+    digest = hashlib.sha256()
+    path = Path(path)
+    files = [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+    for filepath in files:
+        digest.update(str(filepath.relative_to(path)).encode("utf-8") + b"\0")
+        with open(filepath, "rb") as f_in:
+            while data := f_in.read(PIECE_SIZE):
+                digest.update(data)
+    return digest.hexdigest()
+
+
+def makekeys(keyshome):
+    # A vault key without a passphrase, so decrypting never asks for one
+    keyshome.mkdir(mode=0o700)
+    subprocess.run(["gpg", "--homedir", str(keyshome), "--batch", "--passphrase", "", "--pinentry-mode", "loopback",
+                    "--quick-generate-key", VAULT_KEY_NAME, "default", "default", "never"],
+                   check=True, capture_output=True)
+    stopagent(keyshome)
+
+
+def stopagent(keyshome):
+    subprocess.run(["gpgconf", "--homedir", str(keyshome), "--kill", "gpg-agent"], capture_output=True)
+
+
+def stage(source, workdir):
+    # Put a corpus into the import folder of a work folder. Hard links where possible, since archiving deletes
+    # its input and the corpus has to survive.
+    target = workdir / "import" / source.name
+    try:
+        if source.is_dir():
+            shutil.copytree(source, target, copy_function=os.link)
+        else:
+            os.link(source, target)
+    except OSError:
+        shutil.rmtree(target, ignore_errors=True)
+        if source.is_dir():
+            shutil.copytree(source, target)
+        else:
+            shutil.copyfile(source, target)
+    return target
+
+
+def runmain(workdir, args):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, str(MAIN), "--stats", "stats.jsonl"] + args, cwd=workdir,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception("main.py " + " ".join(args) + " failed:\n" + result.stdout + result.stderr)
+    return time.perf_counter() - started
+
+
+def readrecords(workdir):
+    with open(workdir / "stats.jsonl") as f_in:
+        return [json.loads(line) for line in f_in if line.strip()]
+
+
+def roundtrip(source, method, keyshome, extra=()):
+    # Archive a corpus with `method` and restore it again in a fresh work folder. Returns one result per direction.
+    workdir = Path(tempfile.mkdtemp(prefix="work-", dir=BENCH_DIR))
+    try:
+        # Without the sockets of gpg-agent, which can't be copied
+        shutil.copytree(keyshome, workdir / "keys", ignore=shutil.ignore_patterns("S.*"))
+        for folder in ("import", "vault", "out"):
+            (workdir / folder).mkdir()
+        stage(source, workdir)
+        wall = {"archive": runmain(workdir, ["archive", source.name, "--method", method] + list(extra)),
+                "restore": runmain(workdir, ["restore", source.name])}
+        restored = workdir / "out" / source.name
+        if treedigest(restored) != treedigest(source):
+            raise Exception(source.name + " did not survive the round trip with " + method)
+        results = []
+        for record in readrecords(workdir):
+            if record["op"] not in wall:
+                continue
+            results.append({"op": record["op"], "seconds": record["seconds"], "wall": round(wall[record["op"]], 6),
+                            "mb_s": record["mb_s"], "ratio": record["ratio"],
+                            "stages": {name: totals.get("seconds", 0) for name, totals in record["stages"].items()},
+                            "gpg_cpu_seconds": sum(totals.get("gpg_cpu_seconds", 0)
+                                                   for totals in record["stages"].values())})
+        return results
+    finally:
+        stopagent(workdir / "keys")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+REGISTRY_SCRIPT = """
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+import secretarchive
+count = int(sys.argv[2])
+names = ["entry" + str(i) for i in range(count)]
+timings = {}
+started = time.perf_counter()
+secretarchive.addmanytoreg({name: {"ext": "txt", "method": "gz", "is_dir": False, "key": "bench"} for name in names})
+timings["add"] = time.perf_counter() - started
+started = time.perf_counter()
+for name in names:
+    secretarchive.getentry(name)
+timings["lookup"] = time.perf_counter() - started
+for name in names:
+    open(os.path.join(secretarchive.VAULT_DIR, name), "wb").close()
+started = time.perf_counter()
+secretarchive.updatereg(force=True)
+timings["scan"] = time.perf_counter() - started
+started = time.perf_counter()
+secretarchive.updatereg()
+timings["check"] = time.perf_counter() - started
+started = time.perf_counter()
+secretarchive.removefromreg(*names)
+timings["remove"] = time.perf_counter() - started
+print(json.dumps(timings))
+"""
+
+
+def registrybench(count):
+    # Time the registry layer on its own: adding, looking up, reconciling with the vault and removing `count` entries
+    workdir = Path(tempfile.mkdtemp(prefix="work-", dir=BENCH_DIR))
+    try:
+        result = subprocess.run([sys.executable, "-c", REGISTRY_SCRIPT, str(MAIN.parent), str(count)], cwd=workdir,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception("Registry benchmark failed:\n" + result.stderr)
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        return [{"op": "registry-" + step, "seconds": round(seconds, 6), "wall": round(seconds, 6), "mb_s": None,
+                 "ratio": None, "stages": {}, "gpg_cpu_seconds": 0} for step, seconds in timings.items()]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def resultkey(result):
+    return result["corpus"] + "/" + result["size"] + "/" + result["method"] + "/" + result["op"]
+
+
+def printresults(results):
+    print(bcolors.BOLD + "{:<11} {:>6} {:<7} {:<17} {:>9} {:>8} {:>7}  {}".format(
+        "Corpus", "Size", "Method", "Operation", "Seconds", "MB/s", "Ratio", "Slowest stages") + bcolors.ENDC)
+    for result in results:
+        stages = sorted(result["stages"].items(), key=lambda item: -item[1])[:3]
+        print("{:<11} {:>6} {:<7} {:<17} {:>9.3f} {:>8} {:>7}  {}".format(
+            result["corpus"], result["size"], result["method"], result["op"], result["seconds"],
+            "-" if result["mb_s"] is None else "{:.1f}".format(result["mb_s"]),
+            "-" if result["ratio"] is None else "{:.3f}".format(result["ratio"]),
+            ", ".join(name + " " + "{:.2f}".format(seconds) for name, seconds in stages)))
+
+
+def compare(results, baseline, threshold):
+    # Print how each result moved against the baseline. Returns the number of regressions.
+    base = {resultkey(result): result for result in baseline["results"]}
+    regressions = 0
+    print(bcolors.BOLD + "{:<45} {:>10} {:>10} {:>8}".format("Benchmark", "Baseline", "Now", "Change") + bcolors.ENDC)
+    for result in results:
+        old = base.get(resultkey(result))
+        if old is None:
+            continue
+        change = (result["seconds"] - old["seconds"]) / old["seconds"] if old["seconds"] else 0
+        line = "{:<45} {:>10.3f} {:>10.3f} {:>+7.1f}%".format(resultkey(result), old["seconds"], result["seconds"],
+                                                               change * 100)
+        if change > threshold and result["seconds"] - old["seconds"] > MIN_SECONDS:
+            regressions += 1
+            print(bcolors.FAIL + line + "  slower" + bcolors.ENDC)
+        elif change < -threshold and old["seconds"] - result["seconds"] > MIN_SECONDS:
+            print(bcolors.OKGREEN + line + "  faster" + bcolors.ENDC)
+        else:
+            print(line)
+    return regressions
+
+
+def environment():
+    gpg = subprocess.run(["gpg", "--version"], capture_output=True, text=True).stdout.splitlines()
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True)
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "gpg": gpg[0] if gpg else None,
+            "commit": commit.stdout.strip() or None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark archive and restore round trips of main.py on synthetic data.")
+    parser.add_argument("--corpora", default=",".join(CORPORA),
+                        help="comma separated kinds of data: " + ", ".join(CORPORA) + " (default: all)")
+    parser.add_argument("--sizes", default="64K,16M",
+                        help="comma separated corpus sizes, such as 64K,16M,2G (default: 64K,16M)")
+    parser.add_argument("--methods", default=",".join(METHODS),
+                        help="comma separated compression methods to pass to main.py (default: " +
+                             ",".join(METHODS) + ")")
+    parser.add_argument("--repeat", type=int, default=1, help="run everything this many times and keep the fastest")
+    parser.add_argument("--registry-entries", type=int, default=10000,
+                        help="number of entries for the registry benchmark, 0 to skip it (default: 10000)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH),
+                        help="results to compare against (default: bench/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="how much slower than the baseline counts as a regression (default: 0.1, i.e. 10%%)")
+    args = parser.parse_args(argv)
+
+    corpora = [kind.strip() for kind in args.corpora.split(",") if kind.strip()]
+    unknown = [kind for kind in corpora if kind not in CORPORA]
+    if unknown:
+        parser.error("unknown corpora: " + ", ".join(unknown))
+    sizes = [parsesize(size) for size in args.sizes.split(",") if size.strip()]
+    methods = [method.strip() for method in args.methods.split(",") if method.strip()]
+
+    best = {}
+    keyshome = Path(tempfile.mkdtemp(prefix="keys-", dir=BENCH_DIR)) / "keys"
+    try:
+        makekeys(keyshome)
+        for _ in range(max(args.repeat, 1)):
+            for kind in corpora:
+                for size in sizes:
+                    source = makecorpus(kind, size)
+                    for method in methods:
+                        print("Running " + kind + " " + sizename(size) + " " + method, file=sys.stderr)
+                        for result in roundtrip(source, method, keyshome):
+                            result.update(corpus=kind, size=sizename(size), method=method)
+                            if resultkey(result) not in best or result["seconds"] < best[resultkey(result)]["seconds"]:
+                                best[resultkey(result)] = result
+            if args.registry_entries:
+                for result in registrybench(args.registry_entries):
+                    result.update(corpus="registry", size=str(args.registry_entries), method="-")
+                    if resultkey(result) not in best or result["seconds"] < best[resultkey(result)]["seconds"]:
+                        best[resultkey(result)] = result
+    finally:
+        stopagent(keyshome)
+        shutil.rmtree(keyshome.parent, ignore_errors=True)
+
+    results = list(best.values())
+    report = {"environment": environment(), "results": results}
+    printresults(results)
+    if args.output:
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent=1)
+
+    regressions = 0
+    if args.save_baseline:
+        with open(args.baseline, "w") as f_out:
+            json.dump(report, f_out, indent=1)
+        print("Saved as the baseline in " + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f_in:
+            baseline = json.load(f_in)
+        print()
+        print("Compared with the baseline from " + str(baseline["environment"].get("time")) + " (commit " +
+              str(baseline["environment"].get("commit")) + ", " + str(baseline["environment"].get("cpus")) + " CPUs):")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(bcolors.WARNING + str(regressions) + " benchmark(s) got slower" + bcolors.ENDC)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
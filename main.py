@@ -1,231 +1,22 @@
-import gnupg
-import warnings
-import gzip
-import lzma
-import json
+# Command line and interactive menu of Secret Archive. Everything they do is in the secretarchive module,
+# which can be imported on its own to use the vault as a library.
+import argparse
 import os
-import re
 import shutil
+import sys
+import tempfile
+import time
 from pathlib import Path
-import tarfile
-
-GNUPG_HOME = "./keys/"
-VAULT_DIR = "./vault/"
-IMPORT_DIR = "./import/"
-OUT_PATH = "./out/"
-
-Path(GNUPG_HOME).mkdir(exist_ok=True)
-Path(VAULT_DIR).mkdir(exist_ok=True)
-Path(IMPORT_DIR).mkdir(exist_ok=True)
-Path(OUT_PATH).mkdir(exist_ok=True)
-
-
-class bcolors:
-    HEADER = '\033[95m'
-    OKBLUE = '\033[94m'
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
-
-
-def compress(filename, saveasname, method="gzip"):
-    datapath = Path("./import/" + filename)
-    vaultpath = Path("./vault/")
-    if datapath.exists():
-        if method == "gzip":
-            with open(datapath, 'rb') as f_in:
-                with gzip.open(vaultpath / (saveasname + ".gz"), 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-        elif method == "lzma":
-            with open(datapath, 'rb') as f_in:
-                with lzma.open(vaultpath / (saveasname + ".xz"), 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-        else:
-            raise ValueError("Unknown compression method specified")
-    else:
-        raise IOError(
-            "No such file! Please enter a valid filename, or ensure the file is in the 'import' folder")
-
-
-def encrypt(filename, saveasname):
-    vaultpath = Path(VAULT_DIR)
-    datapath = vaultpath / filename
-    if datapath.exists():
-        gpg = gnupg.GPG(gnupghome=GNUPG_HOME)
-        gpg.encoding = "utf-8"
-
-        key = gpg.gen_key(gpg.gen_key_input())
-        fp = key.fingerprint
-
-        with open(datapath, 'rb') as comp_in:
-            encrypted_ascii_data = gpg.encrypt_file(
-                comp_in, fp, output=vaultpath / saveasname)
-
-    else:
-        raise IOError(
-            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
-
-
-def decrypt(filename, ext, method="gzip"):
-    gpg = gnupg.GPG(gnupghome=GNUPG_HOME)
-    gpg.encoding = "utf-8"
-    vaultpath = Path("./vault/")
-    datapath = vaultpath / filename
-    if datapath.exists():
-        with open(datapath, 'rb') as dec:
-            decrypted_data = gpg.decrypt_file(
-                dec, output="./vault/" + datapath.name + (("." + ext) if ext else "") + (".gz" if method == "gzip" else ".xz"))
-        if not Path("./vault/" + datapath.name + (("." + ext) if ext else "") + (".gz" if method == "gzip" else ".xz")).exists():
-            raise Exception("Authentication Failure: No key found for file.")
-    else:
-        raise IOError(
-            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
-
-
-def decompress(filename, method="gzip", is_dir=False):
-    vaultpath = Path("./vault/")
-    datapath = vaultpath / filename
-    output_dir = Path(OUT_PATH)
-    fin_name = datapath.stem
-
-    # if "." in datapath.stem:
-    #     original_extension = "." + datapath.stem.split(".")[-1]
-    #     name = datapath.stem.split(".")[0]
-    # else:
-    #     original_extension = ""
-    #     name = datapath.stem
-
-    if datapath.exists():
-        if method == "gzip":
-            with gzip.open(datapath, "rb") as f:
-                with open(output_dir / (fin_name + (".tar" if is_dir else "")), "wb") as fp:
-                    shutil.copyfileobj(f, fp)
-        elif method == "lzma":
-            with lzma.open(datapath, "rb") as f:
-                with open(output_dir / (fin_name + (".tar" if is_dir else "")), "wb") as fp:
-                    shutil.copyfileobj(f, fp)
-        else:
-            raise ValueError("Unknown compression method specified")
-    else:
-        raise IOError(
-            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
-
-
-def getpropername(name, extension):
-    registry = {}
-    regpath = Path("./registry.json")
-
-#     If registry file exists,
-    if regpath.exists():
-        #         Load the registry into the variable
-        with open(regpath, "rb") as regfile:
-            registry = json.load(regfile)
-#         If such an encrypted file doesn't already exist, return the name the user wanted
-        if not (name in registry):
-            return name
-#         If such an encrypted file exists, ask if user wants to rename it.
-        else:
-            #         Nice litte code block that finds the new name for the renamed file
-            #         If the file name ends in a number enclosed in brackets, increment the number for the new name until such a file doesn't exist
-            newname = name
-            while (newname in registry):
-                if re.match(".*\(\d\)", newname):
-                    while (newname in registry):
-                        initial_part = newname.split("(")[0]
-                        number = int(newname.split("(")[1][:-1])
-                        newname = initial_part + "(" + str(number + 1) + ")"
-    #         Else, just add a ' (1)' at the end of the file
-                else:
-                    newname += " (1)"
-#             Print error and input prompt
-            print("Another encrypted file with the same name already exists. " + (("It has the extension ." +
-                                                                                   registry[name]['ext']) if registry[name]['ext'] else "It has no extension.") + " Do you want to:\n    [1] - Replace the existing encrypted file\n    [2] - Save the new encrypted file as " + newname)
-            k = input(":")
-#             Validate input
-            while not (k in ["1", "2"]):
-                print("\nPlease enter valid input.\nAnother encrypted file with the same name already exists. " + (("It has the extension ." +
-                                                                                                                    registry[name]['ext']) if registry[name]['ext'] else "It has no extension.") + " Do you want to:\n    [1] - Replace the existing encrypted file\n    [2] - Save the new encrypted file as " + newname)
-                k = input(":")
-#             Return name/newname as per input
-            if k == "1":
-                return name
-            else:
-                return newname
-#     If registry file doesn't exist, return the original name the user intended
-    else:
-        return name
-
-
-# Our registry will be in the form of a dictionary. final name is key, and original extension is value.
-def addtoreg(final, originalext, method="gz", is_dir=False):
-    registry = {}
-    regpath = Path("./registry.json")
-
-#     If registry file exists,
-    if regpath.exists():
-        #         Load the registry into the variable
-        with open(regpath, "rb") as regfile:
-            registry = json.load(regfile)
-
-        with open(regpath, "w") as regfile:
-            registry[final] = {"ext": originalext,
-                               "method": method, "is_dir": is_dir}
-            json.dump(registry, regfile)
-#         If such an encrypted file exists, ask if user wants to rename it.
-#     If registry file doesn't exist, add the file to registry and write it to a new registry file.
-    else:
-        with open(regpath, "w") as regfile:
-            registry[final] = {"ext": originalext,
-                               "method": method, "is_dir": is_dir}
-            json.dump(registry, regfile)
-
-
-def updatereg():
-    registry = {}
-    vaultpath = Path("./vault/")
-    regpath = Path("./registry.json")
-
-    if regpath.exists():
-        with open(regpath, "rb") as regfile:
-            registry = json.load(regfile)
-
-        for i in list(vaultpath.glob("*")):
-            if not (i.name in registry):
-                print(bcolors.WARNING + "Warning: " + bcolors.ENDC +
-                      "Unidentified " + ("directory " if i.is_dir() else "file ") + i.name + " in vault")
-
-        todel = [k for k in registry.keys() if k not in [
-            m.name for m in list(vaultpath.glob("*"))]]
-
-        for k in todel:
-            print(bcolors.WARNING + "Warning: " + bcolors.ENDC + ("Directory " if registry[k]['is_dir'] else "File ") +
-                  k + " found in registry, but not in the 'vault' folder.")
-            # registry.pop(k, None)
-
-        with open(regpath, "w") as regfile:
-            json.dump(registry, regfile)
 
+import secretarchive
+from secretarchive import (Archiver, Operation, WATCH_INTERVAL, WATCH_SETTLE, addmanytoreg, archiveentry, bcolors,
+                           compress, decompress, decrypt, encrypt, getpropername, getreg, makedirs, parsemethod,
+                           printsummary, readstats, removefromreg, removesource, restoreentry, setbuffersize, setstats,
+                           splitname, updatereg)
 
-def getreg():
-    updatereg()
-    registry = {}
-    regpath = Path("./registry.json")
-
-    if regpath.exists():
-        with open(regpath, "rb") as regfile:
-            registry = json.load(regfile)
-    return registry
-
-def writereg(registry):
-    regpath = Path("./registry.json")
-
-    with open(regpath, "w") as regfile:
-        json.dump(registry, regfile)
 
 def init():
+    makedirs()
     print("Welcome to Secret Archive! Please choose an action:")
     print("[1] - Compress, Encrypt and add file to vault\n[2] - Decrypt, Decompress and remove file from vault\n[3] - Force run algorithm on file")
     k = input(":")
@@ -236,7 +27,7 @@ def init():
 
     if k == "1":
         updatereg()
-        imports = list(Path(IMPORT_DIR).glob("*"))
+        imports = list(Path(secretarchive.IMPORT_DIR).glob("*"))
         if not imports:
             raise FileNotFoundError("No files in `import` folder")
         for i, file in enumerate(imports):
@@ -250,30 +41,16 @@ def init():
         name = int(name)
         is_dir = imports[name].is_dir()
         name = imports[name]
-        if "." in name.name:
-            stem = ".".join(name.name.split(".")[:-1])
-            ext = name.name.split(".")[-1]
-        else:
-            ext = ""
-            stem = name.name
+        stem, ext = splitname(name.name)
 
         finalname = getpropername(stem, ext)
 
-        while not (method := input("Compression method [gzip / lzma]: ")) in ["lzma", "gzip"]:
-            print("Please enter a valid compression method ('gzip' or 'lzma')")
-
-        if is_dir:
-            with tarfile.open(str(name) + ".tar", "w") as tarf:
-                tarf.add(name)
-            shutil.rmtree(name, ignore_errors=True)
-            name = Path(str(name) + ".tar")
-
-        compress(name.name, finalname, method)
-        encrypt((finalname + (".gz" if method == "gzip" else ".xz")), finalname)
-        os.remove("./vault/" + finalname +
-                  (".gz" if method == "gzip" else ".xz"))
-        os.remove(name)
-        addtoreg(finalname, ext, ("gz" if method == "gzip" else "xz"), is_dir)
+        while not (method := input("Compression method [auto / gzip / lzma]: ")) in ["auto", "lzma", "gzip"]:
+            print("Please enter a valid compression method ('auto', 'gzip' or 'lzma')")
+
+        entry = archiveentry(name, finalname, method, keep=True)
+        addmanytoreg({finalname: entry})
+        removesource(name)
         print(("Folder" if is_dir else "File") +
               " encrypted and saved in vault successfully.")
         return
@@ -304,47 +81,10 @@ def init():
             print("Please enter a valid choice from the list")
             num = input(":")
         num = int(num)
-        decrypt(names[num], exts[num],
-                "gzip" if methods[num] == "gz" else "lzma")
-        decompress(names[num] + ("." if exts[num] else "") +
-                   exts[num] + (".gz" if methods[num] == "gz" else ".xz"), "gzip" if methods[num] == "gz" else "lzma", are_dirs[num])
-        os.remove("./vault/" + names[num] + (("." +
-                                              exts[num]) if exts[num] else "") + "." + methods[num])
-
-        os.remove("./vault/" + names[num])
-        if are_dirs[num]:
-            with tarfile.open(Path(OUT_PATH) / (str(names[num]) + ".tar")) as tarf:
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tarf, Path(OUT_PATH))
-            shutil.copytree(str(Path(OUT_PATH)/"import"/ names[num]), str(Path(OUT_PATH)/names[num]))
-            shutil.rmtree(Path(OUT_PATH)/"import", ignore_errors=True)
-            os.remove(Path(OUT_PATH) / (str(names[num]) + ".tar"))
-        
-        # Remove file from registry
-        reg.pop(names[num])
-
-        regpath = Path("./registry.json")
+        restoreentry(names[num], reg[names[num]])
 
-        with open(regpath, "w") as regfile:
-            json.dump(reg, regfile)
+        # Remove file from registry
+        removefromreg(names[num])
 
         updatereg()
         print(("Folder" if are_dirs[num] else "File") +
@@ -366,7 +106,7 @@ def init():
 
         if choice == "1":
             print("Choose a file to compress from the `import` folder:")
-            imports = list(Path(IMPORT_DIR).glob("*"))
+            imports = list(Path(secretarchive.IMPORT_DIR).glob("*"))
             if not imports:
                 raise FileNotFoundError("No files in `import` folder")
             for i, file in enumerate(imports):
@@ -380,17 +120,14 @@ def init():
             name = int(name)
             is_dir = imports[name].is_dir()
             name = imports[name]
-            while not (method := input("Compression method [gzip / lzma]: ")) in ["lzma", "gzip"]:
-                print("Please enter a valid compression method ('gzip' or 'lzma')")
+            while not (method := input("Compression method [auto / gzip / lzma]: ")) in ["auto", "lzma", "gzip"]:
+                print("Please enter a valid compression method ('auto', 'gzip' or 'lzma')")
 
             if is_dir:
                 print(bcolors.WARNING + "Warning: " + bcolors.ENDC +
                       "compressing folders converts the folder to a tarfile. Decompressing this encrypted file will yield a tarfile that needs to be manually untar-ed.")
-                with tarfile.open(str(name) + ".tar", "w") as tarf:
-                    tarf.add(name)
+                compress(name.name, name.name + ".tar", method)
                 shutil.rmtree(name, ignore_errors=True)
-                compress(name.name + ".tar", name.name + ".tar", method)
-                os.remove(str(name) + ".tar")
                 print("The compressed folder is saved in the `vault` folder.")
                 return
             # Make tarfile if is_dir
@@ -399,7 +136,7 @@ def init():
             print("The compressed file is saved in the `vault` folder.")
         elif choice == "2":
             print("Choose a file to encrypt from the `vault` folder:")
-            imports = list(Path(VAULT_DIR).glob("*"))
+            imports = list(Path(secretarchive.VAULT_DIR).glob("*"))
             
             if not imports:
                 raise FileNotFoundError("No files in `vault` folder")
@@ -418,11 +155,11 @@ def init():
             if is_dir:
                 print(bcolors.WARNING + "Warning: " + bcolors.ENDC +
                       "encrypting folders converts the folder to a tarfile. Decrypting this encrypted file will yield a tarfile that needs to be manually untar-ed.")
-                with tarfile.open(str(name) + ".tar", "w") as tarf:
-                    tarf.add(name)
+                # The folder is being read while the result is written, so it can't be written in its place
+                temppath = Path(secretarchive.VAULT_DIR) / ("." + name.name + ".tmp")
+                encrypt(name.name, temppath.name)
                 shutil.rmtree(name, ignore_errors=True)
-                encrypt(name.name + ".tar", name.name)
-                os.remove(str(name) + ".tar")
+                os.rename(temppath, name)
                 print("The encrypted folder is saved in the `vault` folder.")
                 return
             encrypt(name.name, name.stem)
@@ -430,7 +167,7 @@ def init():
             return
         elif choice == "3":
             print("Choose a file to decrypt from the `vault` folder:")
-            imports = list(Path(VAULT_DIR).glob("*"))
+            imports = list(Path(secretarchive.VAULT_DIR).glob("*"))
             if not imports:
                 raise FileNotFoundError("No files in `vault` folder")
             for i, file in enumerate(imports):
@@ -448,15 +185,15 @@ def init():
             finalname = getpropername(name, ext)
             decrypt(finalname, ext)
             if ext:
-                os.rename("./vault/" + finalname + "." +
-                          ext + ".gz", "./vault/" + finalname + "." + ext)
+                os.rename(secretarchive.VAULT_DIR + finalname + "." +
+                          ext + ".gz", secretarchive.VAULT_DIR + finalname + "." + ext)
             else:
-                os.rename("./vault/" + finalname +
-                          ".gz", "./vault/" + finalname)
+                os.rename(secretarchive.VAULT_DIR + finalname +
+                          ".gz", secretarchive.VAULT_DIR + finalname)
             print("The decrypted file is saved in the `vault` folder.")
         elif choice == "4":
             print("Choose a file to decompress from the `vault` folder:")
-            imports = list(Path(VAULT_DIR).glob("*"))
+            imports = list(Path(secretarchive.VAULT_DIR).glob("*"))
             if not imports:
                 raise FileNotFoundError("No files in `vault` folder")
             for i, file in enumerate(imports):
@@ -478,4 +215,161 @@ def init():
             print("Invalid choice. Quitting.")
 
 
-init()
+def checkmethod(method):
+    # argparse type for --method
+    if method != "auto":
+        try:
+            parsemethod(method)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return method
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compress and encrypt files into a vault. Run without a command for the interactive menu.")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="append a JSON line with the timings, byte counts, compression ratio and throughput of "
+                             "each stage to FILE for every entry processed")
+    parser.add_argument("--summary", action="store_true", help="print a table of those statistics at the end")
+    parser.add_argument("--buffer-size", type=int, default=secretarchive.BUFFER_SIZE // (1024 * 1024), metavar="MIB",
+                        help="size of the reads and writes when streaming data, in MiB (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command")
+
+    archive_parser = commands.add_parser(
+        "archive", help="compress, encrypt and add files from the `import` folder to the vault")
+    archive_parser.add_argument("names", nargs="*", help="names of files or folders in the `import` folder")
+    archive_parser.add_argument("--segmented", action="store_true",
+                                help="store files as separately encrypted segments, so an interrupted archive or "
+                                     "restore carries on where it stopped (always done for files of 1 GiB or more)")
+    archive_parser.add_argument("--incremental", action="store_true",
+                                help="add folders as a new generation of their entry, storing only the files that "
+                                     "changed since the last one, and keep them in the `import` folder")
+
+    restore_parser = commands.add_parser(
+        "restore", help="decrypt, decompress and remove entries from the vault into the `out` folder")
+    restore_parser.add_argument("names", nargs="*", help="names of entries in the registry")
+
+    list_parser = commands.add_parser("list", help="list the files in an indexed or incremental folder entry")
+    list_parser.add_argument("name", help="name of an indexed or incremental entry in the registry")
+    list_parser.add_argument("--generations", action="store_true",
+                             help="list the generations of an incremental entry instead")
+    extract_parser = commands.add_parser(
+        "extract", help="restore files from an indexed or incremental folder entry into the `out` folder, "
+                        "keeping the entry")
+    extract_parser.add_argument("name", help="name of an indexed or incremental entry in the registry")
+    extract_parser.add_argument("patterns", nargs="*",
+                                help="paths inside the folder, folders or glob patterns such as 'docs/*.txt' "
+                                     "(default: everything)")
+    for command_parser in (list_parser, extract_parser):
+        command_parser.add_argument("--generation", type=int,
+                                    help="generation of an incremental entry to use (default: the latest)")
+
+    verify_parser = commands.add_parser(
+        "verify", help="check that vault entries are intact without restoring them, and look for entries missing from "
+                       "the vault or the registry")
+    verify_parser.add_argument("names", nargs="*", help="names of entries in the registry (default: all of them)")
+    verify_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                               help="number of entries to check in parallel (default: number of CPUs)")
+    verify_parser.add_argument("--threads", action="store_true", help="use threads instead of worker processes")
+
+    watch_parser = commands.add_parser(
+        "watch", help="keep archiving whatever is put into the `import` folder, until stopped with Ctrl+C")
+    watch_parser.add_argument("--settle", type=float, default=WATCH_SETTLE,
+                              help="seconds a file or folder has to stay unchanged before it is archived "
+                                   "(default: %(default)s)")
+    watch_parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                              help="seconds between looks at the `import` folder where inotify isn't available "
+                                   "(default: %(default)s)")
+    for command_parser in (archive_parser, watch_parser):
+        command_parser.add_argument("--method", type=checkmethod, default="gzip",
+                                    help="compression method: gzip, lzma or store, optionally with a level such as "
+                                         "gzip-9 or lzma-3, or auto to pick one by sampling each entry "
+                                         "(default: gzip)")
+        command_parser.add_argument("--dedup", action="store_true",
+                                    help="store the entries in the deduplicating chunk store, so data already "
+                                         "in the vault isn't stored again")
+        command_parser.add_argument("--indexed", action="store_true",
+                                    help="store folders with an index, so single files can be listed and extracted "
+                                         "without decrypting the whole folder")
+    watch_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                              help="number of entries to archive in parallel (default: number of CPUs)")
+
+    for command_parser in (archive_parser, restore_parser, watch_parser):
+        command_parser.add_argument("--compress-jobs", type=int, default=secretarchive.COMPRESS_JOBS,
+                                    help="number of processes compressing the blocks of a large file in parallel "
+                                         "(default: number of CPUs, 1 compresses every file as a single stream)")
+    for command_parser in (archive_parser, restore_parser):
+        command_parser.add_argument("--all", action="store_true", help="process every entry")
+        command_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                                    help="number of entries to process in parallel (default: number of CPUs)")
+        command_parser.add_argument("--processes", action="store_true",
+                                    help="use worker processes instead of threads")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        init()
+        return 0
+
+    setbuffersize(max(args.buffer_size, 1) * 1024 * 1024)
+    stats_path = args.stats
+    if args.summary and stats_path is None:
+        fd, stats_path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+    if stats_path is not None:
+        setstats(stats_path)
+        offset = os.path.getsize(stats_path) if os.path.exists(stats_path) else 0
+    try:
+        # The command as a whole is an operation too, which picks up the time spent on the registry
+        with Operation("command", args.command):
+            return runcommand(parser, args)
+    finally:
+        if args.summary:
+            printsummary(readstats(stats_path, offset))
+            if args.stats is None:
+                os.remove(stats_path)
+
+
+def runcommand(parser, args):
+    archiver = Archiver()
+    if args.command in ("list", "extract"):
+        try:
+            if args.command == "list" and args.generations:
+                for number, mtime in archiver.generations(args.name):
+                    print(str(number) + "\t" + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime)))
+                return 0
+            if args.command == "list":
+                for record in archiver.list(args.name, args.generation):
+                    print(record["path"] + ("/" if record["type"] == "dir" else ""))
+                return 0
+            records = archiver.extract(args.name, args.patterns, args.generation)
+        except ValueError as e:
+            parser.error(str(e))
+        if not records:
+            print(bcolors.WARNING + "Nothing matched" + bcolors.ENDC)
+            return 1
+        print("Restored " + str(len(records)) + " item(s) into the `out` folder")
+        return 0
+    if args.command == "verify":
+        return 1 if archiver.verify(args.names or None, max(args.jobs, 1), not args.threads) else 0
+    if args.command == "watch":
+        secretarchive.setcompressjobs(max(args.compress_jobs, 1))
+        return archiver.watch(args.method, max(args.jobs, 1), args.dedup, args.indexed, args.settle, args.interval)
+    if not args.names and not args.all:
+        parser.error("give the names to " + args.command + ", or --all")
+    secretarchive.setcompressjobs(max(args.compress_jobs, 1))
+
+    names = None if args.all else args.names
+    if args.command == "archive":
+        try:
+            failed = archiver.archive(names, args.method, args.jobs, args.processes, args.dedup, args.indexed,
+                                      args.incremental, args.segmented)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    else:
+        failed = archiver.restore(names, args.jobs, args.processes)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
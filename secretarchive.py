@@ -0,0 +1,2986 @@
+import collections
+import contextvars
+import fnmatch
+import warnings
+import gzip
+import hashlib
+import hmac
+import io
+import lzma
+import json
+import mmap
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import tarfile
+
+# Everything lives in these folders and files under ROOT. Use setpaths() to move them somewhere else.
+ROOT = "."
+GNUPG_HOME = "./keys/"
+VAULT_DIR = "./vault/"
+IMPORT_DIR = "./import/"
+OUT_PATH = "./out/"
+# Chunks of deduplicated entries, shared between entries and named after the keyed hash of their contents
+CHUNK_DIR = "./vault/.chunks/"
+REGISTRY_PATH = "./registry.db"
+# The secret key of the keyed hashes, encrypted to the vault key
+HASH_KEY_PATH = "./keys/hash_key.gpg"
+# Registries from before the switch to SQLite are imported from here
+LEGACY_REGISTRY_PATH = "./registry.json"
+
+# User ID of the key every vault entry is encrypted to
+VAULT_KEY_NAME = "Secret Archive Vault Key"
+
+# Size of the reads used when streaming data through the compressor and gpg
+BUFFER_SIZE = 1024 * 1024
+# Input files at least this big are memory-mapped and fed to the compressor straight from the page cache
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Files bigger than a block are compressed as a series of independent blocks on a pool of
+# COMPRESS_JOBS worker processes. Set COMPRESS_JOBS to 1 to always compress as a single stream.
+BLOCK_SIZE = 16 * 1024 * 1024
+COMPRESS_JOBS = os.cpu_count() or 1
+
+# The "auto" method trial compresses this many samples of this size to decide how to compress an entry
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 64 * 1024
+
+# Files of SEGMENT_THRESHOLD bytes or more are archived as a folder of SEGMENT_SIZE segments that are compressed and
+# encrypted on their own, so an interrupted archive or restore only has to redo the segments it was working on
+SEGMENT_SIZE = 256 * 1024 * 1024
+SEGMENT_THRESHOLD = 1024 * 1024 * 1024
+
+# Deduplicated entries are cut into chunks of CHUNK_MIN to CHUNK_MAX bytes, CHUNK_AVERAGE on average.
+# Cut points depend only on the surrounding bytes, so an edit only changes the chunks around it.
+CHUNK_MIN = 256 * 1024
+CHUNK_AVERAGE = 1024 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+# verify checks the chunks of a deduplicated entry this many at a time, as tasks of their own, so that the chunks
+# of one big entry are spread over all the workers
+VERIFY_CHUNK_BATCH = 8
+# Likewise, the blocks of an indexed archive are checked this many at a time, and the segments of a segmented
+# entry one at a time
+VERIFY_BLOCK_BATCH = 8
+# Indexed folder archives store their files' contents in independently compressed and encrypted
+# blocks of this size, so a single file can be restored by decrypting just the blocks it is in
+INDEX_BLOCK_SIZE = 4 * 1024 * 1024
+# Marks the end of an indexed archive, after the length of its encrypted index
+INDEX_MAGIC = b"SAINDEX1"
+
+# JSON lines file that a record of every archive and restore, with per-stage timings and byte counts, is appended to.
+# None turns the instrumentation off.
+STATS_PATH = None
+
+# The watch command archives whatever has stopped changing for WATCH_SETTLE seconds in the import folder, looking
+# every WATCH_INTERVAL seconds where inotify isn't available. Finished entries are written to the registry
+# REGISTRY_BATCH at a time, or every WATCH_FLUSH_INTERVAL seconds, whichever comes first.
+WATCH_SETTLE = 2.0
+WATCH_INTERVAL = 1.0
+REGISTRY_BATCH = 100
+WATCH_FLUSH_INTERVAL = 1.0
+
+# Unreferenced chunks younger than this are left alone, since an archive running in another
+# process may be about to reference them
+CHUNK_GRACE_SECONDS = 60 * 60
+
+
+def setpaths(root="."):
+    # Keep the vault, its keys and its registry under `root`. The paths are module-wide, so a process works with one
+    # vault at a time; keys belonging to the previous one are forgotten, and each thread's registry connection is
+    # replaced the next time it is used.
+    global ROOT, GNUPG_HOME, VAULT_DIR, IMPORT_DIR, OUT_PATH, CHUNK_DIR, REGISTRY_PATH, LEGACY_REGISTRY_PATH
+    global HASH_KEY_PATH, gpg_context, vault_key, hash_key
+    ROOT = str(root)
+    GNUPG_HOME = os.path.join(ROOT, "keys", "")
+    VAULT_DIR = os.path.join(ROOT, "vault", "")
+    IMPORT_DIR = os.path.join(ROOT, "import", "")
+    OUT_PATH = os.path.join(ROOT, "out", "")
+    CHUNK_DIR = os.path.join(VAULT_DIR, ".chunks", "")
+    REGISTRY_PATH = os.path.join(ROOT, "registry.db")
+    LEGACY_REGISTRY_PATH = os.path.join(ROOT, "registry.json")
+    HASH_KEY_PATH = os.path.join(GNUPG_HOME, "hash_key.gpg")
+    with gpg_lock:
+        gpg_context = None
+        vault_key = None
+    with hash_key_lock:
+        hash_key = None
+
+
+def makedirs():
+    # The folders are made when the registry or the keyring is first opened, rather than on import,
+    # so importing this module doesn't touch the file system
+    for path in (GNUPG_HOME, VAULT_DIR, IMPORT_DIR, OUT_PATH):
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+
+# The operation being measured in this context, if any
+current_operation = contextvars.ContextVar("current_operation", default=None)
+# Stages being timed in this thread, innermost last
+stage_stack = threading.local()
+stats_lock = threading.Lock()
+
+
+class Operation:
+    # Collects the stage timings and byte counts of one operation (archiving or restoring an entry, or a whole
+    # command), and appends them to STATS_PATH as a JSON line when it finishes. Does nothing unless stats are on.
+    #
+    # bytes_in and bytes_out are the sizes before and after: the original and the ciphertext when archiving,
+    # the other way round when restoring. Left at None they are taken from the encrypt/decrypt stages.
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.stages = {}
+        self.bytes_in = None
+        self.bytes_out = None
+        self.lock = threading.Lock()
+        self.token = None
+
+    def __enter__(self):
+        if STATS_PATH is not None:
+            self.token = current_operation.set(self)
+            self.start = time.perf_counter()
+        return self
+
+    def add(self, stage, **counts):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {})
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.token is None:
+            return
+        current_operation.reset(self.token)
+        seconds = time.perf_counter() - self.start
+        if self.bytes_in is None:
+            self.bytes_in = self.stages.get("decrypt", {}).get("bytes_in", 0)
+        if self.bytes_out is None:
+            self.bytes_out = self.stages.get("encrypt", {}).get("bytes_out", 0)
+        # Stored size over original size, whichever direction the data went. Meaningless for an extract,
+        # which decrypts whole blocks to get at parts of them.
+        stored, original = (self.bytes_in, self.bytes_out) if self.kind != "archive" else (self.bytes_out, self.bytes_in)
+        record = {"op": self.kind, "name": self.name, "status": "ok" if exc is None else "failed",
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seconds": round(seconds, 6),
+                  "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                  "ratio": round(stored / original, 4) if original and self.kind != "extract" else None,
+                  "mb_s": round(original / 1e6 / seconds, 3) if seconds and original else None, "stages": {}}
+        for stage, totals in self.stages.items():
+            totals = {key: round(value, 6) if isinstance(value, float) else value for key, value in totals.items()}
+            if totals.get("seconds") and (totals.get("bytes_in") or totals.get("bytes_out")):
+                totals["mb_s"] = round(max(totals.get("bytes_in", 0), totals.get("bytes_out", 0)) / 1e6 /
+                                       totals["seconds"], 3)
+            if stage in ("compress", "decompress") and totals.get("bytes_in") and totals.get("bytes_out"):
+                totals["ratio"] = round(min(totals["bytes_in"], totals["bytes_out"]) /
+                                        max(totals["bytes_in"], totals["bytes_out"]), 4)
+            record["stages"][stage] = totals
+        if exc is not None:
+            record["error"] = str(exc)
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with stats_lock:
+            # A single append, so lines from worker processes don't get mixed up
+            fd = os.open(STATS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+class measure:
+    # Times a stage of the current operation: `with measure("compress") as m:`, adding to m.bytes_in and
+    # m.bytes_out inside. Time spent in stages measured inside it counts for those stages, not this one.
+    def __init__(self, stage):
+        self.stage = stage
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.operation = current_operation.get()
+        if self.operation is not None:
+            if not hasattr(stage_stack, "stack"):
+                stage_stack.stack = []
+            stage_stack.stack.append(self)
+            self.nested = 0.0
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.operation is not None:
+            elapsed = time.perf_counter() - self.start
+            stage_stack.stack.pop()
+            if stage_stack.stack:
+                stage_stack.stack[-1].nested += elapsed
+            self.operation.add(self.stage, seconds=elapsed - self.nested, bytes_in=self.bytes_in,
+                               bytes_out=self.bytes_out)
+
+
+def recordstage(stage, **counts):
+    # Add counts that aren't measured with measure() to a stage of the current operation
+    operation = current_operation.get()
+    if operation is not None:
+        operation.add(stage, **counts)
+
+
+class Metered(io.RawIOBase):
+    # Stream wrapper that times the reads or writes on `stream` as a stage, and counts the bytes
+    # written into it (bytes_in) or read out of it (bytes_out). Closing it leaves `stream` open.
+    def __init__(self, stream, stage):
+        self.stream = stream
+        self.stage = stage
+
+    def readable(self):
+        return self.stream.readable()
+
+    def writable(self):
+        return self.stream.writable()
+
+    def readinto(self, b):
+        with measure(self.stage) as m:
+            n = self.stream.readinto(b)
+            m.bytes_out += n
+        return n
+
+    def write(self, data):
+        with measure(self.stage) as m:
+            self.stream.write(data)
+            m.bytes_in += len(data)
+        return len(data)
+
+
+class HashingWriter(io.RawIOBase):
+    # Stream wrapper that adds everything written through it to `digest`. Closing it leaves `stream` open.
+    # With `stream` None the data goes nowhere else.
+    def __init__(self, stream, digest):
+        self.stream = stream
+        self.digest = digest
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        with measure("hash") as m:
+            self.digest.update(data)
+            m.bytes_in += len(data)
+        if self.stream is not None:
+            self.stream.write(data)
+        return len(data)
+
+
+def metered(stream, stage):
+    # `stream` wrapped in Metered when stats are on
+    if current_operation.get() is None:
+        return stream
+    return Metered(stream, stage)
+
+
+def incontext(function):
+    # `function` wrapped to run in a copy of the current context, so that work handed to another
+    # thread still counts towards the operation that started it
+    if current_operation.get() is None:
+        return function
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
+
+
+def setstats(path):
+    global STATS_PATH
+    STATS_PATH = path
+
+
+def readstats(path, offset=0):
+    # Records appended to a stats file since it was `offset` bytes long
+    with open(path, "rb") as f_in:
+        f_in.seek(offset)
+        return [json.loads(line) for line in f_in if line.strip()]
+
+
+def printsummary(records):
+    # Table of the operations in `records`, followed by the stages of all of them put together
+    print(bcolors.BOLD + "{:<10} {:<24} {:>9} {:>10} {:>10} {:>7} {:>8}".format(
+        "Operation", "Name", "Seconds", "In MB", "Out MB", "Ratio", "MB/s") + bcolors.ENDC)
+    stages = {}
+    for record in records:
+        print("{:<10} {:<24} {:>9.2f} {:>10.2f} {:>10.2f} {:>7} {:>8}".format(
+            record["op"], record["name"][:24] + ("" if record["status"] == "ok" else " (failed)"), record["seconds"],
+            record["bytes_in"] / 1e6, record["bytes_out"] / 1e6,
+            "-" if record["ratio"] is None else "{:.3f}".format(record["ratio"]),
+            "-" if record["mb_s"] is None else "{:.1f}".format(record["mb_s"])))
+        for stage, totals in record["stages"].items():
+            combined = stages.setdefault(stage, {})
+            for key in ("seconds", "bytes_in", "bytes_out", "gpg_seconds", "gpg_cpu_seconds"):
+                combined[key] = combined.get(key, 0) + totals.get(key, 0)
+    if stages:
+        print()
+        print(bcolors.BOLD + "{:<12} {:>9} {:>10} {:>10} {:>8} {:>9} {:>9}".format(
+            "Stage", "Seconds", "In MB", "Out MB", "MB/s", "gpg s", "gpg CPU s") + bcolors.ENDC)
+        for stage, totals in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+            size = max(totals["bytes_in"], totals["bytes_out"])
+            print("{:<12} {:>9.2f} {:>10.2f} {:>10.2f} {:>8} {:>9} {:>9}".format(
+                stage, totals["seconds"], totals["bytes_in"] / 1e6, totals["bytes_out"] / 1e6,
+                "{:.1f}".format(size / 1e6 / totals["seconds"]) if totals["seconds"] and size else "-",
+                "{:.2f}".format(totals["gpg_seconds"]) if totals["gpg_seconds"] else "-",
+                "{:.2f}".format(totals["gpg_cpu_seconds"]) if totals["gpg_cpu_seconds"] else "-"))
+
+
+def compress(filename, saveasname, method="gzip", jobs=None):
+    # Folders are written into the compressor as a tar stream
+    datapath = Path(IMPORT_DIR) / filename
+    vaultpath = Path(VAULT_DIR)
+    if datapath.exists():
+        if method == "auto":
+            method = choosemethod(datapath)
+        codec = parsemethod(method)[0]
+        with open(vaultpath / (saveasname + {"gzip": ".gz", "lzma": ".xz", "store": ""}[codec]), 'wb') as f_out:
+            with CompressedWriter(f_out, method, blockjobs(datapath, jobs)) as comp_out:
+                writeinput(tarwriter(datapath) if datapath.is_dir() else datapath, comp_out)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        fsyncpath(vaultpath)
+    else:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'import' folder")
+
+
+block_pool = None
+block_pool_lock = threading.Lock()
+
+
+def getblockpool():
+    # Process pool shared by everything that compresses or decompresses blocks
+    global block_pool
+    with block_pool_lock:
+        if block_pool is None:
+            block_pool = processpool(COMPRESS_JOBS)
+    return block_pool
+
+
+class JobSlots:
+    # Counting semaphore where whoever is waiting for a slot gets the next free one, before any caller that only
+    # tries without waiting. Otherwise an entry with jobs in flight, which takes a slot whenever it frees one, could
+    # keep an entry that has none waiting until it is done.
+    def __init__(self, count):
+        self.free = count
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, blocking=True):
+        with self.condition:
+            if not blocking:
+                if not self.free or self.waiting:
+                    return False
+            else:
+                self.waiting += 1
+                try:
+                    while not self.free:
+                        self.condition.wait()
+                finally:
+                    self.waiting -= 1
+            self.free -= 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.free += 1
+            self.condition.notify()
+
+
+job_slots = None
+job_slots_lock = threading.Lock()
+
+
+def getjobslots():
+    # Process-wide limit on the blocks and gpg jobs in flight, shared by every entry being worked on, so that
+    # memory use and the number of gpg processes don't grow with the number of entries. Sized to keep each worker
+    # of the block pool busy with one job while the next one waits.
+    global job_slots
+    with job_slots_lock:
+        if job_slots is None:
+            job_slots = JobSlots(2 * COMPRESS_JOBS)
+    return job_slots
+
+
+class JobQueue:
+    # Jobs on a pool whose results are taken in the order they were submitted. Each job holds one of the job slots
+    # (see getjobslots()) from when it is submitted until its result is taken or it is cancelled.
+    def __init__(self):
+        self.slots = getjobslots()
+        self.futures = collections.deque()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def reserve(self):
+        # Take a slot for the next job. A queue with jobs in flight doesn't wait for one: its caller has to take
+        # one of its results instead, or two queues could each wait for the slots the other holds.
+        return self.slots.acquire(blocking=not self.futures)
+
+    def submit(self, executor, function, *args):
+        # Submit a job on a slot taken with reserve()
+        try:
+            self.futures.append(executor.submit(function, *args))
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self):
+        # Give back a slot taken with reserve() that went unused
+        self.slots.release()
+
+    def take(self):
+        future = self.futures.popleft()
+        try:
+            return future.result()
+        finally:
+            self.slots.release()
+
+    def cancel(self):
+        # Give up on the jobs still in flight
+        while self.futures:
+            self.futures.popleft().cancel()
+            self.slots.release()
+
+
+def processpool(workers, **kwargs):
+    # Worker processes must not be plain forks: they would inherit the pipes into running gpg
+    # processes, and gpg would never see the end of its input.
+    # Imported here, since many runs never start a process pool and multiprocessing is slow to import.
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, **kwargs)
+
+
+def blockjobs(path, jobs=None):
+    # How many blocks of `path` to compress in parallel. Files that fit in one or two blocks aren't worth
+    # splitting up, so they are compressed as a single stream. A folder counts as the size of its files.
+    jobs = COMPRESS_JOBS if jobs is None else jobs
+    if jobs > 1 and treesize(path) > 2 * BLOCK_SIZE:
+        return jobs
+    return 1
+
+
+def treesize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+               if not os.path.islink(os.path.join(root, name)))
+
+
+def tarwriter(path):
+    # Function that writes a folder into a stream as a tar archive, so it can be fed to the compressor and gpg
+    # without a .tar ever being written to disk
+    def write(out):
+        with measure("tar"):
+            with tarfile.open(fileobj=out, mode="w|", bufsize=BUFFER_SIZE) as tarf:
+                tarf.copybufsize = BUFFER_SIZE
+                tarf.add(path, arcname=Path(path).name)
+    return write
+
+
+def rangewriter(path, offset, length):
+    # Function that writes `length` bytes of a file, starting at `offset`, into the stream it's given
+    def write(out):
+        with open(path, "rb", buffering=0) as f_in:
+            sequential(f_in, offset, length)
+            writemapped(f_in, length, out, offset)
+    return write
+
+
+def writeinput(src, dst):
+    # Copy `src` into `dst`. `src` is a path, a readable stream, or a function that writes into the stream it's given.
+    if callable(src):
+        src(dst)
+    elif isinstance(src, (str, Path)):
+        with open(src, "rb", buffering=0) as f_in:
+            sequential(f_in)
+            size = os.fstat(f_in.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                writemapped(f_in, size, dst)
+            else:
+                writeinput(f_in, dst)
+    else:
+        while True:
+            with measure("read") as m:
+                data = src.read(BUFFER_SIZE)
+                m.bytes_out += len(data)
+            if not data:
+                break
+            dst.write(data)
+
+
+def sequential(f, offset=0, length=0):
+    # Tell the kernel `f` (or `length` bytes of it from `offset`) is about to be read from start to end,
+    # so it reads ahead further
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def writemapped(f_in, size, dst, offset=0):
+    # Copy a large file (or `size` bytes of it from `offset`) into `dst` through a memory map. The compressor reads
+    # each slice straight from the page cache, instead of every BUFFER_SIZE piece being copied into a bytes object first.
+    if not size:
+        return
+    with mmap.mmap(f_in.fileno(), size, access=mmap.ACCESS_READ, offset=offset) as mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for start in range(0, size, BUFFER_SIZE):
+                with view[start:start + BUFFER_SIZE] as piece:
+                    recordstage("read", bytes_out=len(piece))
+                    dst.write(piece)
+
+
+class ProducerReader(io.RawIOBase):
+    # Readable stream of whatever `write` writes into the stream it's given, for consumers that need to read,
+    # like the chunker. `write` runs on a thread; if it fails, reading raises its exception instead of ending.
+    def __init__(self, write):
+        read_fd, write_fd = os.pipe()
+        self.src = open(read_fd, "rb", buffering=0)
+        self.error = None
+        self.thread = threading.Thread(target=incontext(self.run), args=(write, write_fd), daemon=True)
+        self.thread.start()
+
+    def run(self, write, write_fd):
+        try:
+            with open(write_fd, "wb", BUFFER_SIZE) as out:
+                write(out)
+        except BaseException as e:
+            self.error = e
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.src.readinto(b)
+        if not n:
+            self.thread.join()
+            if self.error:
+                raise self.error
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.src.close()
+            self.thread.join()
+        super().close()
+
+
+def fsyncpath(path):
+    # Flush a file, or a folder's list of entries, to disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def parsemethod(method):
+    # Split a compression method such as "gzip", "gzip-1", "lzma-9" or "store" into the codec and its level,
+    # or None for the codec's default level
+    codec, _, level = method.partition("-")
+    if codec not in ("gzip", "lzma", "store") or (level and not level.isdigit()) or (codec == "store" and level):
+        raise ValueError("Unknown compression method specified")
+    if level and int(level) > 9:
+        raise ValueError("Compression level must be between 0 and 9")
+    return codec, (int(level) if level else None)
+
+
+def regmethod(method):
+    # The registry's name for a compression method: "gz" and "xz" as before, with the level appended if one was chosen
+    codec, level = parsemethod(method)
+    if codec == "store":
+        return "store"
+    return ("gz" if codec == "gzip" else "xz") + ("-" + str(level) if level is not None else "")
+
+
+def codecmethod(method):
+    # The compression method for a registry `method` field
+    codec, _, level = method.partition("-")
+    return {"gz": "gzip", "xz": "lzma"}.get(codec, codec) + ("-" + level if level else "")
+
+
+def choosemethod(path):
+    # Pick a compression method for a file or folder by trial compressing a few samples of it. Data that barely
+    # compresses (photos, videos, zips) is only stored, data that compresses a little gets fast gzip, and lzma is
+    # only used where it clearly beats gzip.
+    sample = b"".join(samplecontent(path))
+    if not sample:
+        return "gzip-6"
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > 0.95:
+        return "store"
+    if ratio > 0.7:
+        return "gzip-1"
+    gzipped = len(zlib.compress(sample, 6))
+    if len(lzma.compress(sample, lzma.FORMAT_XZ, preset=1)) < 0.85 * gzipped:
+        return "lzma-6"
+    return "gzip-6"
+
+
+def samplecontent(path, count=SAMPLE_COUNT, size=SAMPLE_SIZE):
+    # Yield up to `count` pieces of up to `size` bytes spread evenly over a file, or over the files of a folder
+    # in proportion to their sizes. The pieces never overlap, since lzma would find the repeats and make the data
+    # look more compressible than it is, and input no bigger than all the pieces together is read whole instead.
+    path = Path(path)
+    if path.is_dir():
+        files = [(Path(root) / name, os.path.getsize(Path(root) / name))
+                 for root, _, names in os.walk(path) for name in names if not os.path.islink(Path(root) / name)]
+    else:
+        files = [(path, path.stat().st_size)]
+    total = sum(length for _, length in files)
+    if not total:
+        return
+    if total <= count * size:
+        for filepath, length in files:
+            if length:
+                with open(filepath, "rb") as f_in:
+                    yield f_in.read()
+        return
+    # Each piece is centred in its share of the input, which is bigger than a piece
+    stride = total / count
+    position = 0
+    for filepath, length in files:
+        # Pieces that start in this file, cut short where it ends
+        starts = [int(n * stride + (stride - size) / 2) - position for n in range(count)]
+        starts = [start for start in starts if 0 <= start < length]
+        position += length
+        if starts:
+            with open(filepath, "rb") as f_in:
+                for start in starts:
+                    f_in.seek(start)
+                    yield f_in.read(size)
+
+
+def detectcodec(data):
+    # Codec of a compressed block, from its magic number
+    if data.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if data.startswith(b"\xfd7zXZ\x00"):
+        return "lzma"
+    return "store"
+
+
+def compressblock(method, data):
+    # Compress a block into a complete gzip member or xz stream. Concatenations of these are still
+    # valid .gz and .xz files, which gunzip, xz, gzip.open and lzma.open all read as a whole.
+    codec, level = parsemethod(method)
+    with measure("compress") as m:
+        if codec == "gzip":
+            compressor = zlib.compressobj(6 if level is None else level, wbits=31)
+            compressed = compressor.compress(data) + compressor.flush()
+        elif codec == "lzma":
+            compressed = lzma.compress(data, lzma.FORMAT_XZ, preset=level)
+        else:
+            compressed = data
+        m.bytes_in += len(data)
+        m.bytes_out += len(compressed)
+    return compressed
+
+
+def decompressblock(method, data):
+    codec = parsemethod(method)[0]
+    with measure("decompress") as m:
+        if codec == "gzip":
+            decompressed = gzip.decompress(data)
+        elif codec == "lzma":
+            decompressed = lzma.decompress(data, lzma.FORMAT_XZ)
+        else:
+            decompressed = data
+        m.bytes_in += len(data)
+        m.bytes_out += len(decompressed)
+    return decompressed
+
+
+class CompressedWriter(io.RawIOBase):
+    # Writable stream that compresses everything written to it and passes the compressed
+    # bytes on to `dst`, so compressed data never has to be staged on disk.
+    # Closing the writer flushes the compressor, but leaves `dst` open.
+    #
+    # With jobs > 1 the input is cut into BLOCK_SIZE blocks that are compressed in parallel on the
+    # block pool, and the compressed size of each block is kept in `blocks` so that they can be
+    # decompressed in parallel again later.
+    def __init__(self, dst, method="gzip", jobs=1):
+        codec, level = parsemethod(method)
+        if codec == "gzip":
+            # wbits=31 makes zlib emit a complete gzip container, readable by gzip.open and gunzip
+            self.compressor = zlib.compressobj(6 if level is None else level, wbits=31)
+        elif codec == "lzma":
+            self.compressor = lzma.LZMACompressor(lzma.FORMAT_XZ, preset=level)
+        else:
+            # Stored data is passed straight through, there is nothing to do in parallel
+            self.compressor = None
+            jobs = 1
+        self.dst = dst
+        self.method = method
+        self.jobs = jobs
+        self.blocks = None
+        if jobs > 1:
+            self.blocks = []
+            self.block = bytearray()
+            self.pending = JobQueue()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.jobs > 1:
+            self.block += data
+            while len(self.block) >= BLOCK_SIZE:
+                self.submitblock(bytes(self.block[:BLOCK_SIZE]))
+                del self.block[:BLOCK_SIZE]
+            return len(data)
+        with measure("compress") as m:
+            compressed = self.compressor.compress(data) if self.compressor else data
+            m.bytes_in += len(data)
+            m.bytes_out += len(compressed)
+        if compressed:
+            self.dst.write(compressed)
+        return len(data)
+
+    def submitblock(self, block):
+        recordstage("compress", bytes_in=len(block))
+        # Only keep a couple of blocks per worker in flight, so memory use stays bounded
+        while not self.pending.reserve():
+            self.writeblock()
+        self.pending.submit(getblockpool(), compressblock, self.method, block)
+        while len(self.pending) > 2 * self.jobs:
+            self.writeblock()
+
+    def writeblock(self):
+        # The blocks are compressed in other processes, so the time spent waiting for them is what counts here
+        with measure("compress") as m:
+            compressed = self.pending.take()
+            m.bytes_out += len(compressed)
+        self.dst.write(compressed)
+        self.blocks.append(len(compressed))
+
+    def close(self):
+        if not self.closed:
+            if self.jobs > 1:
+                try:
+                    if self.block or not (self.blocks or self.pending):
+                        self.submitblock(bytes(self.block))
+                    while self.pending:
+                        self.writeblock()
+                except BaseException:
+                    self.pending.cancel()
+                    raise
+            elif self.compressor:
+                with measure("compress") as m:
+                    compressed = self.compressor.flush()
+                    m.bytes_out += len(compressed)
+                self.dst.write(compressed)
+        super().close()
+
+
+class BlockDecompressedReader(io.RawIOBase):
+    # Readable stream that decompresses output of a parallel CompressedWriter, given the compressed
+    # sizes of its blocks. Blocks are read from `src` ahead of time and decompressed on the block pool.
+    def __init__(self, src, method, blocks, jobs=None):
+        self.src = src
+        self.method = method
+        self.sizes = iter(blocks)
+        self.size = next(self.sizes, None)
+        self.jobs = COMPRESS_JOBS if jobs is None else jobs
+        self.pending = JobQueue()
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.buffer):
+            while len(self.pending) < 2 * self.jobs and self.size is not None and self.pending.reserve():
+                self.submitblock()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.take())
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def submitblock(self):
+        # Read the next block and decompress it on a slot taken with reserve()
+        size, self.size = self.size, next(self.sizes, None)
+        data = bytearray()
+        while len(data) < size and (chunk := self.src.read(size - len(data))):
+            data += chunk
+        if len(data) < size:
+            self.pending.release()
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        self.pending.submit(getblockpool(), decompressblock, self.method, bytes(data))
+
+    def close(self):
+        if not self.closed:
+            self.pending.cancel()
+        super().close()
+
+
+# Constructing a GPG object runs gpg to probe its version, so the process shares a single one
+gpg_context = None
+vault_key = None
+gpg_lock = threading.Lock()
+hash_key = None
+hash_key_lock = threading.Lock()
+
+
+def getgpg():
+    global gpg_context
+    with gpg_lock:
+        if gpg_context is None:
+            # Imported here, since many processes, like most pool workers, never run gpg
+            import gnupg
+            makedirs()
+            gpg_context = gnupg.GPG(gnupghome=GNUPG_HOME)
+            gpg_context.encoding = "utf-8"
+    return gpg_context
+
+
+def getvaultkey():
+    # Fingerprint of the vault key. It is generated the first time anything is archived and reused
+    # afterwards, so each archive operation only pays for the encryption itself. Its fingerprint is kept in the registry.
+    global vault_key
+    gpg = getgpg()
+    with gpg_lock:
+        if vault_key is None:
+            vault_key = getmeta("vault_key")
+        if vault_key is None:
+            for key in gpg.list_keys(secret=True):
+                if any(VAULT_KEY_NAME in uid for uid in key["uids"]):
+                    vault_key = key["fingerprint"]
+                    break
+            else:
+                key = gpg.gen_key(gpg.gen_key_input(name_real=VAULT_KEY_NAME))
+                if not key.fingerprint:
+                    raise Exception("Key generation failed: " + key.stderr)
+                vault_key = key.fingerprint
+            setmeta("vault_key", vault_key)
+    return vault_key
+
+
+def gethashkey():
+    # Secret key of the keyed hashes that name chunks and check entries and segments, so what is stored in the clear
+    # (chunk names, the registry, segment journals) says nothing about the plaintext to someone without the vault
+    # key. It is generated the first time anything is archived and kept next to the keyring, encrypted to the vault
+    # key. Each process decrypts it once.
+    global hash_key
+    fp = getvaultkey()
+    with hash_key_lock:
+        if hash_key is None:
+            path = Path(HASH_KEY_PATH)
+            if not path.exists():
+                key = os.urandom(32)
+                temppath = path.with_name(path.name + "." + str(os.getpid()) + ".tmp")
+                temppath.write_bytes(gpgbytes(["--encrypt", "--recipient", fp], key, "Encryption failed"))
+                fsyncpath(temppath)
+                try:
+                    # Only one process gets to create it. The others use the one that is there.
+                    os.link(temppath, path)
+                    fsyncpath(path.parent)
+                    hash_key = key
+                except FileExistsError:
+                    pass
+                finally:
+                    temppath.unlink()
+            if hash_key is None:
+                hash_key = gpgbytes(["--decrypt"], path.read_bytes(),
+                                    "Authentication Failure: No key found for the hash key.")
+    return hash_key
+
+
+def keyedhash(data=b""):
+    # HMAC-SHA256 of `data` under the hash key. More can be added with update(), as with hashlib.
+    return hmac.new(gethashkey(), data, hashlib.sha256)
+
+
+def gpgpopen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL):
+    # Start a gpg subprocess on the vault keyring. Its status output goes to a temporary file
+    # instead of a pipe, so a chatty gpg can never block while we are streaming data into it.
+    gpg = getgpg()
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(gpg.make_args(args, False), stdin=stdin,
+                            stdout=stdout, stderr=errors)
+    proc.errors = errors
+    proc.stage = "encrypt" if "--encrypt" in args else "decrypt"
+    proc.started = time.perf_counter()
+    return proc
+
+
+def gpgwait(proc, message):
+    # Wait for a gpg subprocess to finish, and raise with gpg's own explanation if it failed
+    if current_operation.get() is not None and proc.returncode is None:
+        # Reaped here rather than by proc.wait(), to get the CPU time gpg used
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        recordstage(proc.stage, gpg_seconds=time.perf_counter() - proc.started,
+                    gpg_cpu_seconds=usage.ru_utime + usage.ru_stime)
+    returncode = proc.wait()
+    proc.errors.seek(0)
+    details = [line for line in proc.errors.read().decode("utf-8", "replace").splitlines()
+               if not line.startswith("[GNUPG:]")]
+    proc.errors.close()
+    if returncode != 0:
+        raise Exception(message + (" (" + " ".join(details) + ")" if details else ""))
+
+
+def gpgabort(proc):
+    # Stop a gpg subprocess we no longer need the result of
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    proc.errors.close()
+
+
+def encryptstream(src, outpath, method=None, jobs=1, armor=True):
+    # Pipe `src` into gpg (compressing it on the way if a method is given, on `jobs` block workers) and write only
+    # the ciphertext to `outpath`. `src` can be anything writeinput() takes. The ciphertext is flushed to disk before
+    # this returns, so the source can be deleted safely afterwards. Returns the registry fields describing the
+    # result: the fingerprint of the key it was encrypted to, the compressed block sizes if it was compressed
+    # in parallel, and the hash of the contents.
+    fp = getvaultkey()
+    blocks = None
+    digest = keyedhash()
+    if os.path.isdir(outpath):
+        raise IsADirectoryError("Cannot write the encrypted output over the folder " + str(outpath))
+    # Only what this call created is cleaned up when it fails
+    created = not os.path.lexists(outpath)
+    # Data that was compressed here already (or deliberately stored) isn't worth gpg compressing again
+    proc = gpgpopen(["--encrypt", "--recipient", fp] + (["--armor"] if armor else []) +
+                    (["--compress-algo", "none"] if method else []) + ["--yes", "--output", str(outpath)])
+    try:
+        gpg_in = metered(proc.stdin, "encrypt")
+        if method:
+            with CompressedWriter(gpg_in, method, jobs) as comp_out:
+                writeinput(src, HashingWriter(comp_out, digest))
+            blocks = comp_out.blocks
+        else:
+            writeinput(src, HashingWriter(gpg_in, digest))
+        proc.stdin.close()
+    except BrokenPipeError:
+        # gpg quit early, gpgwait below reports why
+        pass
+    except BaseException:
+        gpgabort(proc)
+        if created:
+            Path(outpath).unlink(missing_ok=True)
+        raise
+    try:
+        gpgwait(proc, "Encryption failed")
+        with measure("fsync"):
+            fsyncpath(outpath)
+            fsyncpath(Path(outpath).parent)
+        recordstage("encrypt", bytes_out=os.path.getsize(outpath))
+    except Exception:
+        if created:
+            Path(outpath).unlink(missing_ok=True)
+        raise
+    return {"key": fp, "blocks": blocks, "hash": digest.hexdigest()}
+
+
+def encrypt(filename, saveasname):
+    vaultpath = Path(VAULT_DIR)
+    datapath = vaultpath / filename
+    if datapath.exists():
+        return encryptstream(tarwriter(datapath) if datapath.is_dir() else datapath, vaultpath / saveasname)
+    else:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+
+
+def archive(filename, saveasname, method="gzip", jobs=None):
+    # Compress and encrypt a file or folder from the import folder in a single pass. Folders are tarred,
+    # compressed and encrypted as one stream, so the only thing written to the vault is the final ciphertext.
+    datapath = Path(IMPORT_DIR) / filename
+    if datapath.exists():
+        return encryptstream(tarwriter(datapath) if datapath.is_dir() else datapath, Path(VAULT_DIR) / saveasname,
+                             method, blockjobs(datapath, jobs))
+    else:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'import' folder")
+
+
+def decrypt(filename, ext, method="gzip"):
+    gpg = getgpg()
+    vaultpath = Path(VAULT_DIR)
+    datapath = vaultpath / filename
+    if datapath.exists():
+        with open(datapath, 'rb') as dec:
+            decrypted_data = gpg.decrypt_file(
+                dec, output=VAULT_DIR + datapath.name + (("." + ext) if ext else "") + (".gz" if method == "gzip" else ".xz"))
+        if not Path(VAULT_DIR + datapath.name + (("." + ext) if ext else "") + (".gz" if method == "gzip" else ".xz")).exists():
+            raise Exception("Authentication Failure: No key found for file.")
+    else:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+
+
+def decompress(filename, method="gzip", is_dir=False):
+    vaultpath = Path(VAULT_DIR)
+    datapath = vaultpath / filename
+    output_dir = Path(OUT_PATH)
+    fin_name = datapath.stem
+
+    # if "." in datapath.stem:
+    #     original_extension = "." + datapath.stem.split(".")[-1]
+    #     name = datapath.stem.split(".")[0]
+    # else:
+    #     original_extension = ""
+    #     name = datapath.stem
+
+    if datapath.exists():
+        with open(datapath, "rb") as f_in:
+            with decompressedreader(f_in, method) as f:
+                with open(output_dir / (fin_name + (".tar" if is_dir else "")), "wb") as fp:
+                    writeinput(f, fp)
+    else:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+
+
+class StoredReader(io.RawIOBase):
+    # Reads stored (uncompressed) data from `src`, leaving `src` open when closed like the decompressing readers do
+    def __init__(self, src):
+        self.src = src
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.src.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class CodecReader(io.RawIOBase):
+    # Readable stream that decompresses gzip or xz data from `src` with a zlib or lzma decompressor object,
+    # reading BUFFER_SIZE at a time and decompressing straight into the caller's buffer.
+    # Concatenated members, as a parallel CompressedWriter writes, are decompressed one after the other.
+    def __init__(self, src, codec):
+        self.src = src
+        self.codec = codec
+        self.decompressor = self.newdecompressor()
+        self.input = b""
+
+    def newdecompressor(self):
+        if self.codec == "gzip":
+            return zlib.decompressobj(wbits=31)
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not len(b):
+            return 0
+        starved = False
+        while True:
+            if self.decompressor.eof:
+                self.input = self.decompressor.unused_data or self.src.read(BUFFER_SIZE)
+                if not self.input:
+                    return 0
+                self.decompressor = self.newdecompressor()
+            data = self.input
+            # zlib hands back the input it didn't get to as unconsumed_tail, lzma keeps it internally. lzma can
+            # say it needs no input and still have nothing left to give, so a call that gave nothing is fed more.
+            if not data and (starved or getattr(self.decompressor, "needs_input", True)):
+                data = self.src.read(BUFFER_SIZE)
+                if not data:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            output = self.decompressor.decompress(data, len(b))
+            self.input = getattr(self.decompressor, "unconsumed_tail", b"")
+            if output:
+                b[:len(output)] = output
+                return len(output)
+            starved = True
+
+
+def decompressedreader(src, method="gzip", blocks=None):
+    # Readable stream that decompresses `src`. Works on pipes, since none of the readers need to seek.
+    # Output of a parallel compression is decompressed in parallel when its block sizes are known.
+    codec = parsemethod(method)[0]
+    # Not with COMPRESS_JOBS at 1, as in runpool()'s worker processes, which must not start a block pool of their own
+    if codec != "store" and blocks and len(blocks) > 1 and COMPRESS_JOBS > 1:
+        return io.BufferedReader(BlockDecompressedReader(src, method, blocks), BUFFER_SIZE)
+    if codec in ("gzip", "lzma"):
+        return io.BufferedReader(CodecReader(src, codec), BUFFER_SIZE)
+    return io.BufferedReader(StoredReader(src), BUFFER_SIZE)
+
+
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def extractstream(src, path):
+    # Untar a non-seekable stream member by member, placing the archive's top-level folder at `path`.
+    # Folders are archived as `import/<name>`, so stripping the root here means members land at
+    # their final location without an intermediate copy.
+    with tarfile.open(fileobj=src, mode="r|", bufsize=BUFFER_SIZE) as tarf:
+        tarf.copybufsize = BUFFER_SIZE
+        root = None
+        for member in tarf:
+            if root is None:
+                root = member.name
+            member.name = os.path.relpath(member.name, root)
+            if not is_within_directory(path, os.path.join(path, member.name)):
+                raise Exception("Attempted Path Traversal in Tar File")
+            if member.islnk():
+                member.linkname = os.path.relpath(member.linkname, root)
+                if not is_within_directory(path, os.path.join(path, member.linkname)):
+                    raise Exception("Attempted Path Traversal in Tar File")
+            tarf.extract(member, path)
+
+
+def outputpath(filename, ext, is_dir=False):
+    outpath = Path(OUT_PATH) / (filename + (("." + ext) if ext else ""))
+    if is_dir and outpath.exists():
+        raise FileExistsError("A folder named " + outpath.name + " already exists in the `out` folder")
+    return outpath
+
+
+def writeout(f_in, outpath, is_dir=False):
+    # Write a decompressed stream to its place in the out folder, untarring it if it is a folder
+    if is_dir:
+        with measure("untar"):
+            extractstream(f_in, outpath)
+    else:
+        with open(outpath, "wb") as f_out:
+            writeinput(f_in, metered(f_out, "write"))
+    # Read through to the end of the stream so the checksum gets verified and gpg can exit
+    while f_in.read(BUFFER_SIZE):
+        pass
+
+
+def removeoutput(outpath, is_dir=False):
+    # Clean up after a restore that failed halfway
+    if is_dir:
+        shutil.rmtree(outpath, ignore_errors=True)
+    else:
+        outpath.unlink(missing_ok=True)
+
+
+def restore(filename, ext, method="gzip", is_dir=False, blocks=None):
+    # Decrypt, decompress and (for folders) untar a vault entry in one streaming pass.
+    # gpg's output is decompressed as it arrives, so the only thing written to disk is the result in `out`.
+    datapath = Path(VAULT_DIR) / filename
+    if not datapath.exists():
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+    outpath = outputpath(filename, ext, is_dir)
+
+    with open(datapath, 'rb') as enc:
+        sequential(enc)
+        proc = gpgpopen(["--decrypt"], stdin=enc, stdout=subprocess.PIPE)
+        recordstage("decrypt", bytes_in=os.path.getsize(datapath))
+        try:
+            with decompressedreader(metered(proc.stdout, "decrypt"), method, blocks) as f_in:
+                writeout(metered(f_in, "decompress"), outpath, is_dir)
+            while proc.stdout.read(BUFFER_SIZE):
+                pass
+            proc.stdout.close()
+            gpgwait(proc, "Authentication Failure: No key found for file.")
+        except BaseException as e:
+            proc.stdout.close()
+            removeoutput(outpath, is_dir)
+            if isinstance(e, (EOFError, gzip.BadGzipFile, zlib.error, lzma.LZMAError, tarfile.TarError)):
+                # A failed decryption shows up as a truncated stream, so prefer gpg's explanation
+                gpgwait(proc, "Authentication Failure: No key found for file.")
+            else:
+                gpgabort(proc)
+            raise
+
+
+def boundarysymbols(seed, length):
+    # `length` bytes of 0 to 3, as many of each as can be, in a random but fixed order
+    order = sorted(range(length), key=lambda i: hashlib.sha256(seed + bytes([i])).digest())
+    symbols = bytearray(length)
+    for rank, i in enumerate(order):
+        symbols[i] = rank % 4
+    return bytes(symbols)
+
+
+# A chunk ends right after the bytes, each mapped to one of four symbols by BOUNDARY_TABLE, spell out
+# BOUNDARY_PATTERN. That only depends on the last few bytes, and in random data happens once every
+# 4 ** len(BOUNDARY_PATTERN) bytes, so about every CHUNK_AVERAGE bytes. bytes.translate and bytes.find keep the
+# whole search in C. These must never change, or nothing archived before would deduplicate against new chunks.
+BOUNDARY_TABLE = boundarysymbols(b"table", 256)
+BOUNDARY_PATTERN = boundarysymbols(b"pattern", (CHUNK_AVERAGE - 1).bit_length() // 2)
+
+
+def cutpoint(data):
+    # Length of the first chunk in `data`, which holds CHUNK_MAX bytes unless the input ends sooner.
+    # Nothing before CHUNK_MIN can be a boundary, so only the bytes from there on are searched, CHUNK_MIN bytes
+    # at a time so that most of the rest isn't mapped for nothing.
+    end = min(len(data), CHUNK_MAX)
+    start = CHUNK_MIN - len(BOUNDARY_PATTERN)
+    while start + len(BOUNDARY_PATTERN) < end:
+        stop = min(start + CHUNK_MIN, end)
+        found = data[start:stop].translate(BOUNDARY_TABLE).find(BOUNDARY_PATTERN)
+        if found >= 0:
+            return start + found + len(BOUNDARY_PATTERN)
+        # The pattern may straddle the two pieces
+        start = stop - len(BOUNDARY_PATTERN) + 1
+    return end
+
+
+def cdcchunks(src):
+    # Split a stream into content-defined chunks
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < CHUNK_MAX:
+            data = src.read(BUFFER_SIZE)
+            eof = not data
+            buffer += data
+        if not buffer:
+            return
+        cut = cutpoint(buffer)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def chunkpath(digest):
+    return Path(CHUNK_DIR) / digest[:2] / digest
+
+
+def storechunk(chunk, digest, method):
+    # Compress and encrypt a chunk into the chunk store. It is written under a temporary name first,
+    # so a chunk that exists in the store is always complete.
+    path = chunkpath(digest)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temppath = path.with_name(digest + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp")
+    if parsemethod(method)[0] == "store" and detectcodec(chunk) != "store":
+        # readchunk() tells how a chunk was compressed from its first bytes, so a stored chunk must not look compressed
+        method = "gzip-1"
+    encryptstream(io.BytesIO(chunk), temppath, method, armor=False)
+    os.replace(temppath, path)
+    fsyncpath(path.parent)
+
+
+def archivededup(src, method="gzip"):
+    # Cut a stream into chunks, and compress and encrypt the chunks that aren't in the chunk store yet.
+    # Returns the registry fields for the entry, including its chunk manifest.
+    fp = getvaultkey()
+    chunks = []
+    seen = set()
+    workers = max(COMPRESS_JOBS, 2)
+    pending = JobQueue()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            cutter = cdcchunks(src)
+            while True:
+                with measure("chunk") as m:
+                    chunk = next(cutter, None)
+                    if chunk is None:
+                        break
+                    digest = keyedhash(chunk).hexdigest()
+                    m.bytes_in += len(chunk)
+                chunks.append(digest)
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                try:
+                    # Touching a chunk we reuse keeps collectchunks() in other processes away from it
+                    os.utime(chunkpath(digest))
+                except FileNotFoundError:
+                    while not pending.reserve():
+                        pending.take()
+                    pending.submit(executor, incontext(storechunk), chunk, digest, method)
+                    while len(pending) > 2 * workers:
+                        pending.take()
+            while pending:
+                pending.take()
+    except BaseException:
+        pending.cancel()
+        # The chunks of an entry that never made it into the registry are collected like those of a removed one
+        with getdb() as db:
+            queuechunks(db, seen)
+        raise
+    return {"key": fp, "layout": "chunked", "chunks": chunks}
+
+
+def readchunk(digest):
+    # Decrypt and decompress a chunk from the chunk store, checking it against its name.
+    # Entries archived with different methods share chunks, so the method is told from the chunk itself.
+    path = chunkpath(digest)
+    if not path.exists():
+        raise IOError("Chunk " + digest + " is missing from the chunk store")
+    with open(path, "rb") as enc:
+        proc = gpgpopen(["--decrypt"], stdin=enc, stdout=subprocess.PIPE)
+        with measure("decrypt") as m:
+            data = proc.stdout.read()
+            m.bytes_in += os.path.getsize(path)
+            m.bytes_out += len(data)
+        proc.stdout.close()
+        gpgwait(proc, "Authentication Failure: No key found for chunk " + digest + ".")
+    chunk = decompressblock(detectcodec(data), data)
+    if keyedhash(chunk).hexdigest() != digest:
+        raise IOError("Chunk " + digest + " is corrupt")
+    return chunk
+
+
+class ChunkReader(io.RawIOBase):
+    # Readable stream of the contents of a deduplicated entry, reading a few chunks ahead in parallel
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.digest = next(self.chunks, None)
+        self.workers = max(COMPRESS_JOBS, 2)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = JobQueue()
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.buffer):
+            while len(self.pending) < 2 * self.workers and self.digest is not None and self.pending.reserve():
+                self.pending.submit(self.executor, incontext(readchunk), self.digest)
+                self.digest = next(self.chunks, None)
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.take())
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pending.cancel()
+            self.executor.shutdown()
+        super().close()
+
+
+def restorededup(filename, ext, is_dir=False, chunks=()):
+    # Rebuild a deduplicated entry in the out folder from its chunks
+    outpath = outputpath(filename, ext, is_dir)
+    try:
+        with io.BufferedReader(ChunkReader(chunks), BUFFER_SIZE) as f_in:
+            writeout(f_in, outpath, is_dir)
+    except BaseException:
+        removeoutput(outpath, is_dir)
+        raise
+
+
+def queuechunks(db, digests):
+    # Mark chunks as possibly unused, for collectchunks() to look at. Callers commit the transaction.
+    db.executemany("INSERT OR IGNORE INTO freed_chunks (hash) VALUES (?)", [(digest,) for digest in digests])
+
+
+def collectchunks(full=False):
+    # Delete the chunks that no entry refers to any more. Chunks given up by removed or replaced entries are queued
+    # in freed_chunks, and those still inside the grace period stay queued until a later call. `full` looks through
+    # the whole chunk store instead.
+    db = getdb()
+    cutoff = time.time() - CHUNK_GRACE_SECONDS
+    if full:
+        digests = [path.name for path in Path(CHUNK_DIR).glob("*/*") if not path.name.endswith(".tmp")]
+    else:
+        digests = [row["hash"] for row in db.execute("SELECT hash FROM freed_chunks")]
+    done = []
+    for digest in digests:
+        if not db.execute("SELECT 1 FROM manifests WHERE hash = ? LIMIT 1", (digest,)).fetchone():
+            path = chunkpath(digest)
+            try:
+                if path.stat().st_mtime >= cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        done.append(digest)
+    with db:
+        db.executemany("DELETE FROM freed_chunks WHERE hash = ?", [(digest,) for digest in done])
+
+
+def gpgbytes(args, data, message):
+    # Run gpg on an in-memory buffer and return its output. The input is fed from another thread,
+    # so that neither pipe can fill up while we wait on the other.
+    proc = gpgpopen(args, stdout=subprocess.PIPE)
+    feeder = threading.Thread(target=writeclose, args=(proc.stdin, data))
+    feeder.start()
+    with measure(proc.stage) as m:
+        output = proc.stdout.read()
+        m.bytes_in += len(data)
+        m.bytes_out += len(output)
+    feeder.join()
+    proc.stdout.close()
+    gpgwait(proc, message)
+    return output
+
+
+def writeclose(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        # gpg quit early, gpgwait() reports why
+        pass
+
+
+def sealblock(data, method="gzip"):
+    # Compress and encrypt a block of an indexed archive
+    return gpgbytes(["--encrypt", "--recipient", getvaultkey(), "--compress-algo", "none"], compressblock(method, data),
+                    "Encryption failed")
+
+
+def openblock(data, method="gzip"):
+    return decompressblock(method, gpgbytes(["--decrypt"], data, "Authentication Failure: No key found for file."))
+
+
+def walkfolder(path):
+    # (relative path, type, lstat) for everything inside a folder, each folder before its contents
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            fullpath = os.path.join(root, name)
+            stat = os.lstat(fullpath)
+            if os.path.islink(fullpath):
+                kind = "symlink"
+            elif name in dirs:
+                kind = "dir"
+            else:
+                kind = "file"
+            yield os.path.relpath(fullpath, path).replace(os.sep, "/"), kind, stat
+
+
+class IndexWriter:
+    # Writes an indexed folder archive to `out`: the contents of all files one after the other, cut into
+    # INDEX_BLOCK_SIZE blocks that are each compressed and encrypted on their own, then the encrypted index
+    # of files and blocks, then the length of the encrypted index and INDEX_MAGIC.
+    # Records are tagged with `generation` when the archive is one generation of an incremental entry.
+    def __init__(self, out, method="gzip", generation=None):
+        self.out = out
+        self.method = method
+        self.generation = generation
+        self.files = []
+        self.blocks = []
+        self.offset = 0
+        self.buffer = bytearray()
+        self.workers = max(COMPRESS_JOBS, 2)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = JobQueue()
+
+    def add(self, relpath, kind, stat, fullpath):
+        record = {"path": relpath, "type": kind, "mode": stat.st_mode & 0o7777, "mtime": stat.st_mtime}
+        if self.generation is not None:
+            record["generation"] = self.generation
+        if kind == "symlink":
+            record["target"] = os.readlink(fullpath)
+        elif kind == "file":
+            record["offset"] = self.offset
+            digest = hashlib.sha256()
+            with open(fullpath, "rb") as f_in:
+                while True:
+                    with measure("read") as m:
+                        data = f_in.read(BUFFER_SIZE)
+                        m.bytes_out += len(data)
+                    if not data:
+                        break
+                    digest.update(data)
+                    self.buffer += data
+                    self.offset += len(data)
+                    self.submitblocks()
+            record["size"] = self.offset - record["offset"]
+            record["hash"] = digest.hexdigest()
+        self.files.append(record)
+
+    def submitblocks(self, final=False):
+        while len(self.buffer) >= INDEX_BLOCK_SIZE or (final and self.buffer):
+            while not self.pending.reserve():
+                self.writeblock()
+            self.pending.submit(self.executor, incontext(sealblock), bytes(self.buffer[:INDEX_BLOCK_SIZE]), self.method)
+            del self.buffer[:INDEX_BLOCK_SIZE]
+            while len(self.pending) > 2 * self.workers:
+                self.writeblock()
+
+    def writeblock(self):
+        sealed = self.pending.take()
+        self.blocks.append([self.out.tell(), len(sealed)])
+        self.out.write(sealed)
+
+    def close(self):
+        try:
+            self.submitblocks(final=True)
+            while self.pending:
+                self.writeblock()
+        finally:
+            self.pending.cancel()
+            self.executor.shutdown(cancel_futures=True)
+        index = sealblock(json.dumps({"block_size": INDEX_BLOCK_SIZE, "blocks": self.blocks,
+                                      "files": self.files}).encode("utf-8"), self.method)
+        self.out.write(index)
+        self.out.write(struct.pack(">Q", len(index)) + INDEX_MAGIC)
+        self.out.flush()
+        os.fsync(self.out.fileno())
+
+
+def archiveindexed(path, outpath, method="gzip"):
+    # Archive a folder in the indexed layout, which lets single files be listed and restored without
+    # decrypting the whole archive
+    fp = getvaultkey()
+    try:
+        with open(outpath, "wb") as out:
+            writer = IndexWriter(out, method)
+            for relpath, kind, stat in walkfolder(path):
+                writer.add(relpath, kind, stat, os.path.join(path, relpath))
+            writer.close()
+        fsyncpath(Path(outpath).parent)
+    except BaseException:
+        Path(outpath).unlink(missing_ok=True)
+        raise
+    return {"key": fp, "layout": "indexed"}
+
+
+class IndexedArchive:
+    # Read access to an indexed folder archive. Only the index is decrypted up front, blocks are decrypted as needed.
+    def __init__(self, path, method="gzip"):
+        self.method = method
+        self.file = open(path, "rb")
+        self.file.seek(-16, os.SEEK_END)
+        trailer = self.file.read(16)
+        if trailer[8:] != INDEX_MAGIC:
+            self.file.close()
+            raise IOError(str(path) + " is not an indexed archive")
+        length = struct.unpack(">Q", trailer[:8])[0]
+        self.file.seek(-16 - length, os.SEEK_END)
+        self.index = json.loads(openblock(self.file.read(length), method))
+        self.files = self.index["files"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def match(self, patterns=None):
+        # Index records whose path matches one of the glob patterns, or lies in a folder that does
+        if not patterns:
+            return list(self.files)
+        return [record for record in self.files
+                if any(fnmatch.fnmatchcase(record["path"], pattern) or record["path"].startswith(pattern.rstrip("/") + "/")
+                       for pattern in patterns)]
+
+    def readblocks(self, numbers):
+        # Yield (number, contents) for the given blocks in order, decrypting a few of them ahead in parallel
+        workers = max(COMPRESS_JOBS, 2)
+        numbers = iter(numbers)
+        number = next(numbers, None)
+        submitted = collections.deque()
+        pending = JobQueue()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    while len(pending) < 2 * workers and number is not None and pending.reserve():
+                        offset, length = self.index["blocks"][number]
+                        self.file.seek(offset)
+                        pending.submit(executor, incontext(openblock), self.file.read(length), self.method)
+                        submitted.append(number)
+                        number = next(numbers, None)
+                    if not pending:
+                        return
+                    yield submitted.popleft(), pending.take()
+            finally:
+                pending.cancel()
+
+    def extract(self, outpath, patterns=None):
+        # Restore the matching files into `outpath`, decrypting only the blocks they are stored in
+        records = self.match(patterns)
+        makeitems(outpath, records)
+        self.writefiles(outpath, records)
+        setattributes(outpath, records)
+        return records
+
+    def writefiles(self, outpath, records):
+        # Write out the contents of the file records, which must all be stored in this archive
+        size = self.index["block_size"]
+        contents = sorted((record for record in records if record["type"] == "file"), key=lambda r: r["offset"])
+        needed = sorted({number for record in contents if record["size"]
+                         for number in range(record["offset"] // size, (record["offset"] + record["size"] - 1) // size + 1)})
+        blocks = self.readblocks(needed)
+        current, data = -1, b""
+        for record in contents:
+            target = os.path.join(outpath, record["path"])
+            position, remaining = record["offset"], record["size"]
+            with open(target, "wb") as f_out:
+                while remaining:
+                    while current != position // size:
+                        current, data = next(blocks)
+                    start = position - current * size
+                    piece = data[start:start + remaining]
+                    with measure("write") as m:
+                        f_out.write(piece)
+                        m.bytes_in += len(piece)
+                    position += len(piece)
+                    remaining -= len(piece)
+
+    def verify(self, generation=None, part=0, parts=1):
+        # Decrypt every block and check the files stored in them against the hashes in the index, without writing
+        # anything out. Returns the paths that don't match. Only the files of `generation` are stored in one
+        # generation's archive, the others point back into earlier ones. The blocks can be split into `parts`
+        # runs checked separately: this call decrypts run number `part`, and checks the files that start in it.
+        size = self.index["block_size"]
+        count = len(self.index["blocks"])
+        first, last = part * count // parts, (part + 1) * count // parts
+        contents = sorted((record for record in self.files
+                           if record["type"] == "file" and record.get("generation") == generation and
+                           (first <= min(record["offset"] // size, count - 1) < last or not count)),
+                          key=lambda r: r["offset"])
+        needed = set(range(first, last))
+        for record in contents:
+            needed.update(range(record["offset"] // size, (record["offset"] + record["size"] - 1) // size + 1))
+        blocks = self.readblocks(sorted(number for number in needed if number < count))
+        current, data = -1, b""
+        corrupt = []
+        for record in contents:
+            digest = hashlib.sha256()
+            position, remaining = record["offset"], record["size"]
+            while remaining:
+                while current != position // size:
+                    current, data = next(blocks, (None, b""))
+                    if current is None:
+                        raise IOError("blocks are missing from the archive")
+                piece = data[position - current * size:position - current * size + remaining]
+                if not piece:
+                    raise IOError("block " + str(current) + " is shorter than it should be")
+                with measure("hash") as m:
+                    digest.update(piece)
+                    m.bytes_in += len(piece)
+                position += len(piece)
+                remaining -= len(piece)
+            if digest.hexdigest() != record["hash"]:
+                corrupt.append(record["path"])
+        # Blocks past the last file are decrypted too, so that damage there doesn't go unnoticed
+        for _ in blocks:
+            pass
+        return corrupt
+
+
+def makeitems(outpath, records):
+    # Create the folders and symlinks of an indexed archive's records, and the folders their files go in
+    for record in records:
+        if not is_within_directory(outpath, os.path.join(outpath, record["path"])):
+            raise Exception("Attempted Path Traversal in Archive")
+    Path(outpath).mkdir(parents=True, exist_ok=True)
+    for record in records:
+        target = os.path.join(outpath, record["path"])
+        os.makedirs(target if record["type"] == "dir" else os.path.dirname(target), exist_ok=True)
+        if record["type"] == "symlink":
+            os.symlink(record["target"], target)
+
+
+def setattributes(outpath, records):
+    # Folders last, since writing their contents changes their mtime
+    for record in sorted(records, key=lambda r: r["type"] != "file"):
+        target = os.path.join(outpath, record["path"])
+        if record["type"] != "symlink":
+            os.chmod(target, record["mode"])
+            os.utime(target, (record["mtime"], record["mtime"]))
+
+
+def hashfile(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        while data := f_in.read(BUFFER_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def generations(path):
+    # Generation numbers of an incremental entry's folder in the vault, oldest first
+    return sorted(int(child.name) for child in Path(path).iterdir() if child.name.isdigit())
+
+
+def archiveincremental(path, vaultpath, method="gzip"):
+    # Add a generation to an incremental folder entry. Its index lists the whole folder, but only files that were
+    # added or changed since the previous generation are stored in it; the rest refer back to the generation that
+    # already holds them. A file counts as unchanged if its size and mtime match, or failing that its hash does.
+    vaultpath = Path(vaultpath)
+    vaultpath.mkdir(exist_ok=True)
+    existing = generations(vaultpath)
+    previous = {}
+    if existing:
+        with IndexedArchive(vaultpath / str(existing[-1]), method) as archive_in:
+            previous = {record["path"]: record for record in archive_in.files}
+    generation = existing[-1] + 1 if existing else 1
+    outpath = vaultpath / str(generation)
+    temppath = vaultpath / ("." + str(generation) + ".tmp")
+    fp = getvaultkey()
+    changed = 0
+    try:
+        with open(temppath, "wb") as out:
+            writer = IndexWriter(out, method, generation)
+            for relpath, kind, stat in walkfolder(path):
+                fullpath = os.path.join(path, relpath)
+                old = previous.pop(relpath, None)
+                if kind == "file" and old is not None and old["type"] == "file" and old["size"] == stat.st_size and (
+                        old["mtime"] == stat.st_mtime or old["hash"] == hashfile(fullpath)):
+                    writer.files.append(dict(old, mode=stat.st_mode & 0o7777, mtime=stat.st_mtime))
+                    continue
+                if kind == "file":
+                    changed += 1
+                writer.add(relpath, kind, stat, fullpath)
+            writer.close()
+        os.replace(temppath, outpath)
+        fsyncpath(vaultpath)
+    except BaseException:
+        temppath.unlink(missing_ok=True)
+        if not existing:
+            shutil.rmtree(vaultpath, ignore_errors=True)
+        raise
+    removed = sum(record["type"] == "file" for record in previous.values())
+    print(Path(path).name + ": generation " + str(generation) + ", " + str(changed) + " file(s) added or changed, " +
+          str(removed) + " removed")
+    return {"key": fp, "layout": "incremental"}
+
+
+def restoreindexed(filename, ext, method="gzip", patterns=None, generation=None):
+    # Restore all of an indexed archive, or just the files matching `patterns`, into the out folder.
+    # For an incremental entry this rebuilds `generation`, by default the latest one.
+    datapath = Path(VAULT_DIR) / filename
+    if not datapath.exists():
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+    outpath = Path(OUT_PATH) / (filename + (("." + ext) if ext else ""))
+    if not patterns and outpath.exists():
+        raise FileExistsError("A folder named " + outpath.name + " already exists in the `out` folder")
+    existed = outpath.exists()
+    try:
+        if not datapath.is_dir():
+            with IndexedArchive(datapath, method) as archive_in:
+                return archive_in.extract(outpath, patterns)
+        generation = generation or generations(datapath)[-1]
+        with IndexedArchive(datapath / str(generation), method) as archive_in:
+            records = archive_in.match(patterns)
+            makeitems(outpath, records)
+            stored = collections.defaultdict(list)
+            for record in records:
+                stored[record["generation"]].append(record)
+            for number, group in stored.items():
+                if number == generation:
+                    archive_in.writefiles(outpath, group)
+                else:
+                    with IndexedArchive(datapath / str(number), method) as older:
+                        older.writefiles(outpath, group)
+            setattributes(outpath, records)
+            return records
+    except BaseException:
+        if not existed:
+            shutil.rmtree(outpath, ignore_errors=True)
+        raise
+
+
+def readjournal(path):
+    # Header and finished segments ({number: record}) of a segment journal, or (None, {}) if there isn't one.
+    # A line cut short by a crash ends the journal there; the segments after it are simply done again.
+    try:
+        with open(path, "rb") as journal:
+            lines = journal.read().splitlines()
+    except FileNotFoundError:
+        return None, {}
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            break
+    if not records:
+        return None, {}
+    return records[0], {record["segment"]: record for record in records[1:]}
+
+
+def writejournal(path, header, segments):
+    # Start a segment journal over with just `header` and `segments`, replacing whatever was there in one go
+    temppath = Path(path).with_name("." + Path(path).name + ".tmp")
+    with open(temppath, "wb") as journal:
+        for record in [header] + [segments[number] for number in sorted(segments)]:
+            journal.write((json.dumps(record) + "\n").encode("utf-8"))
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(temppath, path)
+    fsyncpath(Path(path).parent)
+
+
+def appendjournal(path, record):
+    # Record a finished segment. Segments finish on several threads, so each one is a single append.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def segmentcount(header):
+    return max(1, -(-header["size"] // header["segment_size"]))
+
+
+def unfinishedsegments(path):
+    # Vault name of an interrupted segmented archive of the file at `path`, if it hasn't changed since
+    stat = os.stat(path)
+    with os.scandir(VAULT_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir() or getentry(entry.name) is not None:
+                continue
+            header = readjournal(os.path.join(entry.path, "journal"))[0]
+            if header and (header["source"], header["size"], header["mtime"]) == (
+                    Path(path).name, stat.st_size, stat.st_mtime_ns):
+                return entry.name
+    return None
+
+
+def runsegments(function, numbers, jobs, *args):
+    # Run `function(number, *args)` for the segment numbers on `jobs` threads, stopping at the first failure
+    def run(number):
+        if stopping.is_set():
+            raise Exception("Interrupted, run it again to carry on from the last finished segment")
+        function(number, *args)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(incontext(run), number) for number in numbers]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def archivesegmented(path, vaultpath, method="gzip", jobs=None):
+    # Archive a large file as a folder of SEGMENT_SIZE segments, each compressed and encrypted on its own, `jobs`
+    # at a time. Finished segments are recorded in the folder's journal, which doubles as the entry's index.
+    # Archiving the same unchanged file into the same folder again carries on from the segments already there.
+    path = Path(path)
+    vaultpath = Path(vaultpath)
+    stat = os.stat(path)
+    header = {"source": path.name, "size": stat.st_size, "mtime": stat.st_mtime_ns, "segment_size": SEGMENT_SIZE,
+              "method": method}
+    journalpath = vaultpath / "journal"
+    previous, done = readjournal(journalpath)
+    if previous != header:
+        if previous is None and vaultpath.exists() and any(vaultpath.iterdir()):
+            raise FileExistsError(vaultpath.name + " already exists in the vault")
+        # Segments of a different file, or of this one before it changed
+        shutil.rmtree(vaultpath, ignore_errors=True)
+        done = {}
+    vaultpath.mkdir(exist_ok=True)
+    writejournal(journalpath, header, done)
+    fp = getvaultkey()
+    todo = [number for number in range(segmentcount(header)) if number not in done]
+    if done:
+        print(path.name + ": resuming with " + str(len(todo)) + " of " + str(segmentcount(header)) + " segments to go")
+    runsegments(sealsegment, todo, COMPRESS_JOBS if jobs is None else jobs, path, vaultpath, header)
+    return {"key": fp, "layout": "segmented"}
+
+
+def sealsegment(number, path, vaultpath, header):
+    # Compress and encrypt one segment of a file. It is written under a temporary name first, so that a segment
+    # in the vault is always complete, and only recorded in the journal once it is safely on disk.
+    offset = number * header["segment_size"]
+    length = min(header["segment_size"], header["size"] - offset)
+    temppath = vaultpath / ("." + str(number) + ".tmp")
+    result = encryptstream(rangewriter(path, offset, length), temppath, header["method"], armor=False)
+    os.replace(temppath, vaultpath / str(number))
+    fsyncpath(vaultpath)
+    appendjournal(vaultpath / "journal", {"segment": number, "size": length, "hash": result["hash"]})
+
+
+def restoresegmented(filename, ext, jobs=None):
+    # Restore a segmented entry into the out folder, `jobs` segments at a time. The file is put together under
+    # a hidden name with a journal of the segments written so far, so an interrupted restore carries on from there,
+    # and only gets its real name once it is complete.
+    vaultpath = Path(VAULT_DIR) / filename
+    header, segments = readjournal(vaultpath / "journal")
+    if header is None:
+        raise IOError(
+            "No such file! Please enter a valid filename, or ensure the file is in the 'vault' folder")
+    if set(segments) != set(range(segmentcount(header))):
+        raise IOError("Segments of " + filename + " are missing from the vault")
+    outpath = outputpath(filename, ext)
+    partpath = outpath.with_name("." + outpath.name + ".part")
+    journalpath = outpath.with_name("." + outpath.name + ".journal")
+    restoreheader = {"entry": filename, "size": header["size"], "mtime": header["mtime"]}
+    previous, done = readjournal(journalpath)
+    if previous != restoreheader or not partpath.exists():
+        done = {}
+        partpath.unlink(missing_ok=True)
+    writejournal(journalpath, restoreheader, done)
+    with open(partpath, "ab") as f_out:
+        f_out.truncate(header["size"])
+    todo = [number for number in sorted(segments) if number not in done]
+    if done:
+        print(outpath.name + ": resuming with " + str(len(todo)) + " of " + str(len(segments)) + " segments to go")
+    runsegments(opensegment, todo, COMPRESS_JOBS if jobs is None else jobs, vaultpath, segments, header,
+                partpath, journalpath)
+    os.replace(partpath, outpath)
+    fsyncpath(outpath.parent)
+    journalpath.unlink()
+
+
+def opensegment(number, vaultpath, segments, header, partpath, journalpath):
+    # Decrypt and decompress one segment into its place in the file being restored, checking it against its hash
+    digest = keyedhash()
+    with open(partpath, "r+b") as f_out:
+        f_out.seek(number * header["segment_size"])
+        decryptinto(vaultpath / str(number), HashingWriter(metered(f_out, "write"), digest), header["method"])
+        written = f_out.tell() - number * header["segment_size"]
+        with measure("fsync"):
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    if digest.hexdigest() != segments[number]["hash"] or written != segments[number]["size"]:
+        raise IOError("Segment " + str(number) + " of " + vaultpath.name + " is corrupt")
+    appendjournal(journalpath, {"segment": number})
+
+
+def freename(name, taken):
+    newname = name
+    #         Nice litte code block that finds the new name for the renamed file
+    #         If the file name ends in a number enclosed in brackets, increment the number for the new name until such a file doesn't exist
+    while (newname in taken):
+        if re.match(".*\(\d\)", newname):
+            while (newname in taken):
+                initial_part = newname.split("(")[0]
+                number = int(newname.split("(")[1][:-1])
+                newname = initial_part + "(" + str(number + 1) + ")"
+    #         Else, just add a ' (1)' at the end of the file
+        else:
+            newname += " (1)"
+    return newname
+
+
+def splitname(filename):
+    # Split a file name into the name it is stored under in the vault and its extension
+    if "." in filename:
+        return ".".join(filename.split(".")[:-1]), filename.split(".")[-1]
+    return filename, ""
+
+
+# Columns of the registry table, besides the entry name. Columns added here later on are added to
+# existing registries the next time they are opened.
+REGISTRY_COLUMNS = {
+    "ext": "TEXT NOT NULL DEFAULT ''",
+    "method": "TEXT NOT NULL DEFAULT 'gz'",
+    "is_dir": "INTEGER NOT NULL DEFAULT 0",
+    "key": "TEXT",
+    "blocks": "TEXT",
+    # "stream" for a single compressed and encrypted file, "chunked" for deduplicated entries,
+    # "indexed" for folders stored as separately encrypted blocks plus an index, "incremental" for folders of
+    # indexed generations, "segmented" for large files stored as a folder of separately encrypted segments
+    "layout": "TEXT NOT NULL DEFAULT 'stream'",
+    # keyedhash() of what was compressed and encrypted (a folder's tar stream), for the verify command.
+    # Chunks and the files of indexed archives have hashes of their own instead.
+    "hash": "TEXT",
+}
+# Columns holding lists or dicts, which are stored as JSON
+JSON_COLUMNS = ("blocks",)
+
+registry_local = threading.local()
+
+
+def getdb():
+    # SQLite connection to the registry, one per thread. The first connection in a process creates
+    # the schema and imports an old registry.json if there is one.
+    db = getattr(registry_local, "db", None)
+    if db is not None and registry_local.path != REGISTRY_PATH:
+        # setpaths() has moved on to another vault since this thread last used the registry
+        db.close()
+        db = None
+    if db is None:
+        makedirs()
+        db = sqlite3.connect(REGISTRY_PATH, timeout=60)
+        db.row_factory = sqlite3.Row
+        # WAL lets readers carry on while another process is writing
+        db.execute("PRAGMA journal_mode=WAL")
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(entries)")}
+            for column, definition in REGISTRY_COLUMNS.items():
+                if column not in existing:
+                    db.execute("ALTER TABLE entries ADD COLUMN " + column + " " + definition)
+            db.execute("CREATE INDEX IF NOT EXISTS entries_method ON entries (method)")
+            # Chunk manifests of deduplicated entries, in order
+            db.execute("CREATE TABLE IF NOT EXISTS manifests "
+                       "(name TEXT, seq INTEGER, hash TEXT, PRIMARY KEY (name, seq))")
+            db.execute("CREATE INDEX IF NOT EXISTS manifests_hash ON manifests (hash)")
+            # Chunks that may have lost their last reference, waiting for collectchunks()
+            db.execute("CREATE TABLE IF NOT EXISTS freed_chunks (hash TEXT PRIMARY KEY)")
+            # Last known state of the vault folder, so updatereg() only has to look at it when it has changed
+            db.execute("CREATE TABLE IF NOT EXISTS vault_snapshot "
+                       "(name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, is_dir INTEGER)")
+            # The watch command's queue: what it found in the import folder, the name it will have in the vault,
+            # its size and mtime when it was queued, and whether it is queued, archived or failed
+            db.execute("CREATE TABLE IF NOT EXISTS ingest "
+                       "(name TEXT PRIMARY KEY, finalname TEXT, size INTEGER, mtime INTEGER, state TEXT)")
+            importlegacyreg(db)
+        registry_local.db = db
+        registry_local.path = REGISTRY_PATH
+    return db
+
+
+def importlegacyreg(db):
+    # Copy the entries of a registry.json into the database, once
+    regpath = Path(LEGACY_REGISTRY_PATH)
+    if not regpath.exists() or getmeta("legacy_imported", db):
+        return
+    with open(regpath, "rb") as regfile:
+        registry = json.load(regfile)
+    db.executemany("INSERT OR IGNORE INTO entries (name, ext, method, is_dir, key) VALUES (?, ?, ?, ?, ?)",
+                   [(name, entry.get("ext", ""), entry.get("method", "gz"), entry.get("is_dir", False), entry.get("key"))
+                    for name, entry in registry.items()])
+    setmeta("legacy_imported", "1", db)
+
+
+def getmeta(name, db=None):
+    row = (db or getdb()).execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+    return row["value"] if row else None
+
+
+def setmeta(name, value, db=None):
+    db = db or getdb()
+    with db:
+        db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+
+def rowtoentry(row):
+    entry = dict(row)
+    entry.pop("name")
+    entry["is_dir"] = bool(entry["is_dir"])
+    for column in JSON_COLUMNS:
+        if entry.get(column) is not None:
+            entry[column] = json.loads(entry[column])
+    return entry
+
+
+def getentry(name):
+    row = getdb().execute("SELECT * FROM entries WHERE name = ?", (name,)).fetchone()
+    return rowtoentry(row) if row else None
+
+
+def getmanifest(name):
+    return [row["hash"] for row in getdb().execute("SELECT hash FROM manifests WHERE name = ? ORDER BY seq", (name,))]
+
+
+def takennames(name):
+    # Names in the registry that start with `name`, which is all freename() needs to look at.
+    # The chunk store's folder counts as taken too.
+    rows = getdb().execute("SELECT name FROM entries WHERE name >= ? AND name < ?", (name, name + "\U0010ffff"))
+    return {row["name"] for row in rows} | {Path(CHUNK_DIR).name}
+
+
+def getpropername(name, extension):
+    existing = getentry(name)
+#         If such an encrypted file doesn't already exist, return the name the user wanted
+    if existing is None:
+        return name
+#         If such an encrypted file exists, ask if user wants to rename it.
+    newname = freename(name, takennames(name))
+#             Print error and input prompt
+    print("Another encrypted file with the same name already exists. " + (("It has the extension ." +
+                                                                           existing['ext']) if existing['ext'] else "It has no extension.") + " Do you want to:\n    [1] - Replace the existing encrypted file\n    [2] - Save the new encrypted file as " + newname)
+    k = input(":")
+#             Validate input
+    while not (k in ["1", "2"]):
+        print("\nPlease enter valid input.\nAnother encrypted file with the same name already exists. " + (("It has the extension ." +
+                                                                                                            existing['ext']) if existing['ext'] else "It has no extension.") + " Do you want to:\n    [1] - Replace the existing encrypted file\n    [2] - Save the new encrypted file as " + newname)
+        k = input(":")
+#             Return name/newname as per input
+    if k == "1":
+        return name
+    else:
+        return newname
+
+
+# Each registry entry is keyed by its name in the vault, and records the original extension, the compression method,
+# whether it was a folder and the key it was encrypted to.
+def addtoreg(final, originalext, method="gz", is_dir=False, key=None):
+    addmanytoreg({final: {"ext": originalext, "method": method, "is_dir": is_dir, "key": key}})
+
+
+def addmanytoreg(entries):
+    # Insert or replace several entries in one transaction
+    with measure("registry"):
+        db = getdb()
+        with db:
+            writeentries(db, entries)
+
+
+def writeentries(db, entries):
+    # The inserts of addmanytoreg(), for callers that need them in a transaction of their own
+    for name, entry in entries.items():
+        columns = ["name"] + [column for column in entry if column in REGISTRY_COLUMNS]
+        values = [name] + [json.dumps(entry[column]) if column in JSON_COLUMNS and entry[column] is not None
+                           else entry[column] for column in columns[1:]]
+        db.execute("INSERT OR REPLACE INTO entries (" + ", ".join(columns) + ") VALUES (" +
+                   ", ".join("?" * len(columns)) + ")", values)
+        queuechunks(db, [row["hash"] for row in db.execute("SELECT hash FROM manifests WHERE name = ?", (name,))])
+        db.execute("DELETE FROM manifests WHERE name = ?", (name,))
+        if entry.get("chunks"):
+            db.executemany("INSERT INTO manifests (name, seq, hash) VALUES (?, ?, ?)",
+                           [(name, seq, digest) for seq, digest in enumerate(entry["chunks"])])
+
+
+def removefromreg(*names):
+    # Remove entries from the registry, along with any chunks only they were using
+    with measure("registry"):
+        db = getdb()
+        with db:
+            for name in names:
+                queuechunks(db, [row["hash"] for row in db.execute("SELECT hash FROM manifests WHERE name = ?", (name,))])
+                db.execute("DELETE FROM manifests WHERE name = ?", (name,))
+                db.execute("DELETE FROM entries WHERE name = ?", (name,))
+    collectchunks()
+
+
+def scanvault():
+    # One pass over the vault folder: name -> (size, mtime, is_dir)
+    vault = {}
+    with os.scandir(VAULT_DIR) as entries:
+        for entry in entries:
+            stat = entry.stat()
+            vault[entry.name] = (stat.st_size, stat.st_mtime_ns, entry.is_dir())
+    return vault
+
+
+def snapshotvault(db):
+    # Bring the stored snapshot of the vault folder up to date, writing only the rows that changed
+    vault = scanvault()
+    snapshot = {row["name"]: (row["size"], row["mtime"], bool(row["is_dir"]))
+                for row in db.execute("SELECT * FROM vault_snapshot")}
+    with db:
+        db.executemany("DELETE FROM vault_snapshot WHERE name = ?", [(name,) for name in snapshot.keys() - vault.keys()])
+        db.executemany("INSERT OR REPLACE INTO vault_snapshot (name, size, mtime, is_dir) VALUES (?, ?, ?, ?)",
+                       [(name,) + stat for name, stat in vault.items() if snapshot.get(name) != stat])
+
+
+def updatereg(force=False):
+    # Warn about files in the vault that aren't in the registry and vice versa. The vault folder is only scanned
+    # when its mtime says something was added or removed since the last check; `force` scans it regardless,
+    # and also looks through the whole chunk store for unused chunks, not just the queued ones.
+    with measure("registry"):
+        db = getdb()
+        vault_mtime = str(os.stat(VAULT_DIR).st_mtime_ns)
+        if force or vault_mtime != getmeta("vault_mtime", db):
+            snapshotvault(db)
+            # Saved after the scan, but read before it, so anything that changes during the scan gets picked up next time
+            setmeta("vault_mtime", vault_mtime, db)
+    collectchunks(force)
+
+    for row in db.execute("SELECT name, is_dir FROM vault_snapshot WHERE name NOT IN (SELECT name FROM entries) "
+                          "AND name != ?", (Path(CHUNK_DIR).name,)):
+        print(bcolors.WARNING + "Warning: " + bcolors.ENDC +
+              "Unidentified " + ("directory " if row["is_dir"] else "file ") + row["name"] + " in vault")
+
+    # Deduplicated entries only live in the chunk store
+    for row in db.execute("SELECT name, is_dir FROM entries WHERE layout != 'chunked' "
+                          "AND name NOT IN (SELECT name FROM vault_snapshot)"):
+        print(bcolors.WARNING + "Warning: " + bcolors.ENDC + ("Directory " if row["is_dir"] else "File ") +
+              row["name"] + " found in registry, but not in the 'vault' folder.")
+
+
+def getreg(update=True):
+    # `update` can be turned off by callers that have just reconciled the registry with the vault
+    if update:
+        updatereg()
+    return {row["name"]: rowtoentry(row) for row in getdb().execute("SELECT * FROM entries ORDER BY rowid")}
+
+
+def writereg(registry):
+    # Replace the whole registry with `registry`, in one transaction
+    with measure("registry"):
+        db = getdb()
+        with db:
+            db.execute("DELETE FROM entries")
+            queuechunks(db, [row["hash"] for row in db.execute("SELECT DISTINCT hash FROM manifests")])
+            db.execute("DELETE FROM manifests")
+            writeentries(db, registry)
+
+
+def archiveentry(path, finalname, method="gzip", dedup=False, indexed=False, incremental=False, keep=False,
+                 segmented=False):
+    # Compress and encrypt a file or folder from the import folder into the vault as `finalname`,
+    # remove the original, and return the registry record for it. With `dedup` it goes into the chunk store instead,
+    # and with `indexed` folders are stored in the indexed layout. With `incremental` a folder is added as a new
+    # generation of `finalname` and kept in the import folder, so it can be archived again later.
+    # With `keep` the original is left for the caller to remove. Files are stored in resumable segments
+    # with `segmented`, or when they are at least SEGMENT_THRESHOLD bytes.
+    path = Path(path)
+    is_dir = path.is_dir()
+    stem, ext = splitname(path.name)
+    with Operation("archive", finalname) as op:
+        if STATS_PATH is not None:
+            op.bytes_in = treesize(path)
+        if method == "auto":
+            method = choosemethod(path)
+        if is_dir and incremental and not dedup:
+            entry = {"ext": ext, "method": regmethod(method), "is_dir": is_dir}
+            entry.update(archiveincremental(path, Path(VAULT_DIR) / finalname, method))
+            return entry
+        if is_dir and indexed and not dedup:
+            entry = {"ext": ext, "method": regmethod(method), "is_dir": is_dir}
+            entry.update(archiveindexed(path, Path(VAULT_DIR) / finalname, method))
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+            return entry
+        if not is_dir and not dedup and (segmented or path.stat().st_size >= SEGMENT_THRESHOLD):
+            entry = {"ext": ext, "method": regmethod(method), "is_dir": is_dir}
+            entry.update(archivesegmented(path, Path(VAULT_DIR) / finalname, method))
+            if not keep:
+                os.remove(path)
+            return entry
+
+        # Folders are tarred straight into the compressor. The original is only deleted once what was
+        # written to the vault is safely on disk.
+        entry = {"ext": ext, "method": regmethod(method), "is_dir": is_dir}
+        if dedup:
+            src = io.BufferedReader(ProducerReader(tarwriter(path)), BUFFER_SIZE) if is_dir else open(path, "rb")
+            with src:
+                entry.update(archivededup(src, method))
+        else:
+            entry.update(archive(path.name, finalname, method))
+        if not keep:
+            removesource(path)
+        return entry
+
+
+def removesource(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+
+def restoreentry(name, entry):
+    # Restore a vault entry into the out folder and remove it from the vault
+    method = codecmethod(entry["method"])
+    with Operation("restore", name) as op:
+        if entry.get("layout") == "chunked":
+            # The chunks are removed with the registry entry, once no other entry needs them
+            restorededup(name, entry["ext"], entry["is_dir"], getmanifest(name))
+        elif entry.get("layout") == "indexed":
+            restoreindexed(name, entry["ext"], method)
+            os.remove(Path(VAULT_DIR) / name)
+        elif entry.get("layout") == "incremental":
+            restoreindexed(name, entry["ext"], method)
+            shutil.rmtree(Path(VAULT_DIR) / name)
+        elif entry.get("layout") == "segmented":
+            restoresegmented(name, entry["ext"])
+            shutil.rmtree(Path(VAULT_DIR) / name)
+        else:
+            restore(name, entry["ext"], method, entry["is_dir"], entry.get("blocks"))
+            os.remove(Path(VAULT_DIR) / name)
+        if STATS_PATH is not None:
+            op.bytes_out = treesize(Path(OUT_PATH) / (name + (("." + entry["ext"]) if entry["ext"] else "")))
+
+
+# Set when the user interrupts a batch, to stop the entries still running at the next segment
+stopping = threading.Event()
+
+
+def setcompressjobs(jobs):
+    global COMPRESS_JOBS, job_slots
+    COMPRESS_JOBS = jobs
+    with job_slots_lock:
+        job_slots = None
+
+
+def setbuffersize(size):
+    global BUFFER_SIZE
+    BUFFER_SIZE = size
+
+
+def initworker(jobs, stats_path, buffer_size, root):
+    # Settings for worker processes of runpool(), which start out with the defaults
+    setpaths(root)
+    setcompressjobs(jobs)
+    setstats(stats_path)
+    setbuffersize(buffer_size)
+
+
+def runpool(function, tasks, jobs=None, processes=False):
+    # Run `function(*task)` for every task on a pool of workers, yielding (task, result, error) as each one finishes.
+    # Threads are enough for most work since gpg runs as a subprocess and zlib/lzma release the GIL,
+    # but a process pool is available for when they are not.
+    # An earlier batch in this process may have been interrupted
+    stopping.clear()
+    if processes:
+        # Entries already run a process each, so the workers compress their blocks themselves
+        executor = processpool(jobs, initializer=initworker, initargs=(1, STATS_PATH, BUFFER_SIZE, ROOT))
+    else:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    with executor:
+        futures = {executor.submit(function, *task): task for task in tasks}
+        finished = set()
+        try:
+            for future in as_completed(futures):
+                finished.add(future)
+                error = future.exception()
+                yield futures[future], (None if error else future.result()), error
+        except KeyboardInterrupt:
+            # Nothing new is started, and segmented work stops at the next segment. Whatever was already running
+            # still finishes, so it is reported before giving up, for its results to make it into the registry.
+            stopping.set()
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if future not in finished and not future.cancelled():
+                    error = future.exception()
+                    yield futures[future], (None if error else future.result()), error
+            raise
+
+
+def archivebatch(paths, method="gzip", jobs=None, processes=False, dedup=False, indexed=False, incremental=False,
+                 segmented=False):
+    # Archive several files or folders from the import folder without prompting. Name clashes are resolved by
+    # renaming, and the registry is written once at the end. Originals are only removed after that, so an entry
+    # is never lost between the two. Returns the number of entries that failed.
+    updatereg()
+    # Make sure the vault key exists before the workers start, so they don't race to create it
+    getvaultkey()
+
+    tasks = []
+    for path in paths:
+        stem = splitname(Path(path).name)[0]
+        entry = getentry(stem)
+        if incremental and entry is not None and entry.get("layout") == "incremental":
+            # A new generation of the existing entry, which has to keep using the same compression method
+            tasks.append((path, stem, codecmethod(entry["method"]), dedup, indexed, incremental, True, segmented))
+            continue
+        # A large file whose archive was interrupted goes back into the same folder, to pick up where it left off
+        finalname = None
+        if not dedup and Path(path).is_file() and (segmented or os.path.getsize(path) >= SEGMENT_THRESHOLD):
+            finalname = unfinishedsegments(path)
+        finalname = finalname or freename(stem, takennames(stem) | {task[1] for task in tasks})
+        tasks.append((path, finalname, method, dedup, indexed, incremental, True, segmented))
+
+    failed = 0
+    added = {}
+    archived = []
+    try:
+        for (path, finalname, *_), entry, error in runpool(archiveentry, tasks, jobs, processes):
+            if error:
+                failed += 1
+                print(bcolors.FAIL + "Failed: " + bcolors.ENDC + Path(path).name + ": " + str(error))
+            else:
+                added[finalname] = entry
+                if entry.get("layout") != "incremental":
+                    archived.append(path)
+                print(Path(path).name + " saved in vault as " + finalname +
+                      (" (" + entry["method"] + ")" if method == "auto" else ""))
+    finally:
+        # Record whatever finished, even if the batch was interrupted
+        addmanytoreg(added)
+        for path in archived:
+            removesource(path)
+    return failed
+
+
+def restorebatch(names, jobs=None, processes=False):
+    # Restore several vault entries into the out folder without prompting, and update the registry once at the end.
+    # Returns the number of entries that failed.
+    updatereg()
+
+    failed = 0
+    tasks = []
+    for name in names:
+        entry = getentry(name)
+        if entry is not None:
+            tasks.append((name, entry))
+        else:
+            failed += 1
+            print(bcolors.FAIL + "Failed: " + bcolors.ENDC + name + " is not in the registry")
+
+    restored = []
+    try:
+        for (name, _), _, error in runpool(restoreentry, tasks, jobs, processes):
+            if error:
+                failed += 1
+                print(bcolors.FAIL + "Failed: " + bcolors.ENDC + name + ": " + str(error))
+            else:
+                restored.append(name)
+                print(name + " decrypted and saved in `out` folder")
+    finally:
+        removefromreg(*restored)
+    return failed
+
+
+def decryptinto(datapath, dst, method="gzip", blocks=None):
+    # Decrypt and decompress a file from the vault into the stream `dst`
+    with open(datapath, 'rb') as enc:
+        sequential(enc)
+        proc = gpgpopen(["--decrypt"], stdin=enc, stdout=subprocess.PIPE)
+        recordstage("decrypt", bytes_in=os.path.getsize(datapath))
+        try:
+            with decompressedreader(metered(proc.stdout, "decrypt"), method, blocks) as f_in:
+                writeinput(metered(f_in, "decompress"), dst)
+            while proc.stdout.read(BUFFER_SIZE):
+                pass
+            proc.stdout.close()
+            gpgwait(proc, "Decryption failed")
+        except BaseException as e:
+            proc.stdout.close()
+            if isinstance(e, (EOFError, zlib.error, lzma.LZMAError)):
+                gpgwait(proc, "Decryption failed")
+            else:
+                gpgabort(proc)
+            raise
+
+
+def verifychunks(digests):
+    # Check chunks of the chunk store, returning {digest: what is wrong} for the ones that aren't intact
+    corrupt = {}
+    for digest in digests:
+        try:
+            readchunk(digest)
+        except Exception as e:
+            corrupt[digest] = str(e)
+    return corrupt
+
+
+def verifyentry(name, entry, part=None):
+    # Check a vault entry is intact without restoring it, raising if it isn't. Big entries are checked in parts,
+    # `part` being the one this call should check, or None for the whole entry:
+    # - a deduplicated entry's chunks are checked separately, `part` being the ones this call should check; they
+    #   are returned as verifychunks() does
+    # - for a segmented entry, the number of a segment
+    # - for an indexed or incremental entry, (generation, run, runs): run number `run` of `runs` runs of the
+    #   blocks of that generation's archive, see IndexedArchive.verify()
+    # Entries archived before content hashes were stored are only checked for decryption and codec errors.
+    method = codecmethod(entry["method"])
+    datapath = Path(VAULT_DIR) / name
+    with Operation("verify", name) as op:
+        op.bytes_out = 0
+        if entry.get("layout") == "chunked":
+            return verifychunks(part or ())
+        if entry.get("layout") in ("indexed", "incremental"):
+            if part is not None:
+                generation, run, runs = part
+                archives = [(datapath if generation is None else datapath / str(generation), generation)]
+            elif entry["layout"] == "incremental":
+                run, runs = 0, 1
+                archives = [(datapath / str(number), number) for number in generations(datapath)]
+                if not archives:
+                    raise IOError("it has no generations")
+            else:
+                run, runs = 0, 1
+                archives = [(datapath, None)]
+            corrupt = []
+            for path, generation in archives:
+                with IndexedArchive(path, method) as archive_in:
+                    missing = {record["generation"] for record in archive_in.files
+                               if record.get("generation") is not None and record.get("generation") != generation and
+                               not (datapath / str(record["generation"])).exists()}
+                    if missing and not run:
+                        raise IOError("generation " + ", ".join(map(str, sorted(missing))) + " is missing")
+                    corrupt += archive_in.verify(generation, run, runs)
+                    if not run:
+                        op.bytes_out += sum(record.get("size", 0) for record in archive_in.files
+                                            if record.get("generation") == generation)
+            if corrupt:
+                raise IOError(str(len(corrupt)) + " file(s) don't match their hashes: " + ", ".join(corrupt[:5]) +
+                              (", ..." if len(corrupt) > 5 else ""))
+            return {}
+        if entry.get("layout") == "segmented":
+            header, segments = readjournal(datapath / "journal")
+            if header is None or set(segments) != set(range(segmentcount(header))):
+                raise IOError("segments are missing")
+            for number, record in sorted(segments.items()):
+                if part is not None and number != part:
+                    continue
+                digest = keyedhash()
+                decryptinto(datapath / str(number), HashingWriter(None, digest), method)
+                if digest.hexdigest() != record["hash"]:
+                    raise IOError("segment " + str(number) + " doesn't match the hash stored when it was archived")
+                op.bytes_out += record.get("size", 0)
+            return {}
+        digest = keyedhash()
+        decryptinto(datapath, HashingWriter(None, digest), method, entry.get("blocks"))
+        op.bytes_out = op.stages.get("decompress", {}).get("bytes_out")
+        if entry.get("hash") and digest.hexdigest() != entry["hash"]:
+            raise IOError("the contents don't match the hash stored when it was archived")
+        return {}
+
+
+def verifyparts(name, entry):
+    # The parts verifyentry() checks a segmented, indexed or incremental entry in. If the entry is missing
+    # anything, it is checked whole, which reports what is wrong.
+    datapath = Path(VAULT_DIR) / name
+    if entry.get("layout") == "segmented":
+        header, segments = readjournal(datapath / "journal")
+        if header is None or set(segments) != set(range(segmentcount(header))):
+            return [None]
+        return sorted(segments)
+    if entry.get("layout") in ("indexed", "incremental"):
+        archives = [(datapath, None)]
+        if entry["layout"] == "incremental":
+            archives = [(datapath / str(number), number) for number in generations(datapath)]
+            if not archives:
+                return [None]
+        # The blocks of an archive are split into runs of about VERIFY_BLOCK_BATCH blocks. How many blocks there
+        # are is in the encrypted index, so the runs are counted from the archive's size, which is what
+        # decrypting them costs anyway.
+        parts = []
+        for path, generation in archives:
+            runs = max(1, path.stat().st_size // (VERIFY_BLOCK_BATCH * INDEX_BLOCK_SIZE))
+            parts.extend((generation, run, runs) for run in range(runs))
+        return parts
+    return [None]
+
+
+def verifybatch(names=None, jobs=None, processes=True):
+    # Check vault entries (all of them if `names` is None) in parallel without restoring them, and report entries
+    # that are corrupt, in the registry but missing from the vault, or in the vault but not in the registry.
+    # Returns the number of problems found.
+    collectchunks()
+    with measure("registry"):
+        db = getdb()
+        rows = db.execute("SELECT * FROM entries").fetchall()
+        entries = {row["name"]: rowtoentry(row) for row in rows if names is None or row["name"] in names}
+        vault = scanvault()
+    problems = 0
+    for name in (names or ()):
+        if name not in entries:
+            problems += 1
+            print(bcolors.FAIL + "Failed: " + bcolors.ENDC + name + " is not in the registry")
+
+    # Big entries are split into parts checked as separate tasks, so that they are spread over all the workers.
+    # Chunks are shared between entries, so each one is checked only once, by the first entry that refers to it.
+    tasks = []
+    checked = set()
+    unhashed = 0
+    for name, entry in entries.items():
+        if entry.get("layout") == "chunked":
+            chunks = [digest for digest in dict.fromkeys(getmanifest(name)) if digest not in checked]
+            checked.update(chunks)
+            tasks.extend((name, entry, chunks[i:i + VERIFY_CHUNK_BATCH])
+                         for i in range(0, len(chunks), VERIFY_CHUNK_BATCH))
+            if not chunks:
+                tasks.append((name, entry, []))
+        elif name not in vault:
+            problems += 1
+            print(bcolors.FAIL + "Missing: " + bcolors.ENDC + name + " is in the registry, but not in the vault")
+        else:
+            unhashed += entry.get("layout") in (None, "stream") and not entry.get("hash")
+            tasks.extend((name, entry, part) for part in verifyparts(name, entry))
+
+    corrupt = {}
+    badchunks = {}
+    for (name, *_), result, error in runpool(verifyentry, tasks, jobs, processes):
+        if error:
+            # A block shared by two parts of an entry gives the same error twice
+            if str(error) not in corrupt.get(name, "").split("; "):
+                corrupt[name] = corrupt[name] + "; " + str(error) if name in corrupt else str(error)
+        else:
+            badchunks.update(result)
+    for name, entry in entries.items():
+        if entry.get("layout") == "chunked":
+            bad = [digest for digest in dict.fromkeys(getmanifest(name)) if digest in badchunks]
+            if bad:
+                corrupt[name] = str(len(bad)) + " bad chunk(s), " + badchunks[bad[0]]
+    for name, reason in sorted(corrupt.items()):
+        print(bcolors.FAIL + "Corrupt: " + bcolors.ENDC + name + ": " + reason)
+    problems += len(corrupt)
+
+    if names is None:
+        in_flight = {row["finalname"] for row in db.execute("SELECT finalname FROM ingest")}
+        for name, (_, _, is_dir) in sorted(vault.items()):
+            if name not in entries and name != Path(CHUNK_DIR).name and name not in in_flight:
+                problems += 1
+                print(bcolors.WARNING + "Orphaned: " + bcolors.ENDC + ("directory " if is_dir else "file ") + name +
+                      " is in the vault, but not in the registry")
+        # Chunks no entry refers to, leaving alone the young ones an archive may be about to refer to,
+        # and those already queued for collection
+        cutoff = time.time() - CHUNK_GRACE_SECONDS
+        referenced = {row["hash"] for row in db.execute("SELECT DISTINCT hash FROM manifests")}
+        referenced.update(row["hash"] for row in db.execute("SELECT hash FROM freed_chunks"))
+        orphans = [path for path in Path(CHUNK_DIR).glob("*/*")
+                   if not path.name.endswith(".tmp") and path.name not in referenced and path.stat().st_mtime < cutoff]
+        if orphans:
+            problems += 1
+            print(bcolors.WARNING + "Orphaned: " + bcolors.ENDC + str(len(orphans)) +
+                  " chunk(s) no entry refers to in the chunk store")
+
+    verified = len({name for name, *_ in tasks})
+    print("Verified " + str(verified) + " entries, " + str(verified - len(corrupt)) + " intact" +
+          (", " + str(problems) + " problem(s) found" if problems else ""))
+    if unhashed:
+        print(bcolors.WARNING + "Warning: " + bcolors.ENDC + str(unhashed) + " entries were archived before content "
+              "hashes were stored, and were only checked for decryption and decompression errors")
+    return problems
+
+
+def treestate(path):
+    # Size and latest mtime of a file, or of everything in a folder, to tell when it has stopped changing
+    info = os.stat(path)
+    if not os.path.isdir(path):
+        return info.st_size, info.st_mtime_ns
+    size, mtime = 0, info.st_mtime_ns
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            info = os.lstat(os.path.join(root, name))
+            mtime = max(mtime, info.st_mtime_ns)
+            if name in files:
+                size += info.st_size
+    return size, mtime
+
+
+def scanimport(skip=()):
+    # treestate() of everything in the import folder but the names in `skip`. Hidden names are left alone,
+    # so whatever is copying files in can write them under a dotted name and rename them when it is done.
+    found = {}
+    for name in os.listdir(IMPORT_DIR):
+        if name.startswith(".") or name in skip:
+            continue
+        try:
+            found[name] = treestate(os.path.join(IMPORT_DIR, name))
+        except FileNotFoundError:
+            pass
+    return found
+
+
+def inotifywatch(path):
+    # Non-blocking file descriptor that becomes readable whenever something is created, written, or moved into
+    # `path`, or None where inotify isn't available
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+    # Imported here, like asyncio in Watcher, since only watch() needs it
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class Watcher:
+    # Archives whatever is dropped into the import folder until it is stopped.
+    #
+    # Files and folders are queued once they have stopped changing for `settle` seconds, and archived by `jobs`
+    # workers on a thread pool. The queue lives in the registry's ingest table, so a restart picks up where the
+    # last run left off. Only a couple of entries per worker are handed out at a time: when the workers fall
+    # behind, the scanner waits for them instead of piling up work. Finished entries are written to the registry
+    # in batches, in the same transaction that marks them archived, and only then are the originals removed.
+    def __init__(self, method="gzip", jobs=None, dedup=False, indexed=False, settle=WATCH_SETTLE,
+                 interval=WATCH_INTERVAL):
+        self.method = method
+        self.jobs = jobs or os.cpu_count() or 1
+        self.dedup = dedup
+        self.indexed = indexed
+        self.settle = settle
+        self.interval = interval
+        # name -> (treestate, when it was first seen in that state), for what hasn't settled yet
+        self.seen = {}
+        # Queued names that have been handed to the workers
+        self.dispatched = set()
+        # (name, finalname, entry) of everything archived since the last flush
+        self.done = []
+
+    async def run(self):
+        # asyncio is imported by the methods that use it rather than by the module, since it is slow to import
+        # and only watch() needs it
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=2 * self.jobs)
+        self.wake = asyncio.Event()
+        self.flushnow = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        fd = inotifywatch(IMPORT_DIR)
+        if fd is not None:
+            loop.add_reader(fd, self.onevent, fd)
+        print("Watching the `import` folder" + (" (polling)" if fd is None else "") + ", press Ctrl+C to stop")
+
+        await self.removearchived()
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.jobs)]
+        flusher = asyncio.create_task(self.flusher())
+        scanner = asyncio.create_task(self.scanner(fd is not None))
+        try:
+            await self.stopping.wait()
+        finally:
+            # Whatever is still waiting in the queue stays in the ingest table for next time
+            scanner.cancel()
+            while not self.queue.empty():
+                self.dispatched.discard(self.queue.get_nowait())
+            for _ in workers:
+                await self.queue.put(None)
+            await asyncio.gather(*workers, return_exceptions=True)
+            flusher.cancel()
+            await self.flush()
+            if fd is not None:
+                loop.remove_reader(fd)
+                os.close(fd)
+            self.executor.shutdown()
+
+    def onevent(self, fd):
+        try:
+            while os.read(fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        self.wake.set()
+
+    async def scanner(self, notified):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = {row["name"]: row for row in getdb().execute("SELECT * FROM ingest")}
+            # Failed entries are looked at again, in case they have been replaced
+            skip = {name for name, row in rows.items() if row["state"] != "failed"}
+            found = await loop.run_in_executor(None, scanimport, skip)
+            self.queuesettled(found, rows)
+
+            for row in getdb().execute("SELECT name, finalname FROM ingest WHERE state = 'queued' ORDER BY rowid"):
+                if row["name"] not in self.dispatched:
+                    self.dispatched.add(row["name"])
+                    # Waits here while the workers are busy with what they already have
+                    await self.queue.put(row["name"])
+
+            # With inotify nothing needs looking at until something changes, or something is waiting to settle
+            timeout = self.settle if notified and self.seen else None if notified else self.interval
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def queuesettled(self, found, rows):
+        # Queue everything in `found` that has been in the same state for `settle` seconds
+        now = time.monotonic()
+        # Something that failed is only tried again once it has changed
+        found = {name: state for name, state in found.items()
+                 if name not in rows or (rows[name]["size"], rows[name]["mtime"]) != state}
+        self.seen = {name: self.seen[name] if name in self.seen and self.seen[name][0] == state else (state, now)
+                     for name, state in found.items()}
+        settled = [name for name, (state, since) in self.seen.items() if now - since >= self.settle]
+        if not settled:
+            return
+        with measure("registry"):
+            db = getdb()
+            with db:
+                queued = {row["finalname"] for row in db.execute("SELECT finalname FROM ingest")}
+                for name in settled:
+                    stem = splitname(name)[0]
+                    finalname = rows[name]["finalname"] if name in rows else freename(stem, takennames(stem) | queued)
+                    queued.add(finalname)
+                    size, mtime = self.seen.pop(name)[0]
+                    db.execute("INSERT OR REPLACE INTO ingest (name, finalname, size, mtime, state) "
+                               "VALUES (?, ?, ?, ?, 'queued')", (name, finalname, size, mtime))
+
+    async def worker(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while (name := await self.queue.get()) is not None:
+            row = getdb().execute("SELECT * FROM ingest WHERE name = ?", (name,)).fetchone()
+            path = Path(IMPORT_DIR) / name
+            try:
+                if not path.exists():
+                    raise IOError("it was removed from the `import` folder before it could be archived")
+                entry = await loop.run_in_executor(self.executor, archiveentry, path, row["finalname"], self.method,
+                                                   self.dedup, self.indexed, False, True)
+            except Exception as e:
+                print(bcolors.FAIL + "Failed: " + bcolors.ENDC + name + ": " + str(e))
+                # Ctrl+C reaches gpg too, so whatever fails while stopping is left queued for next time
+                if not self.stopping.is_set():
+                    with getdb() as db:
+                        db.execute("UPDATE ingest SET state = 'failed' WHERE name = ?", (name,))
+                self.dispatched.discard(name)
+            else:
+                print(name + " saved in vault as " + row["finalname"] +
+                      (" (" + entry["method"] + ")" if self.method == "auto" else ""))
+                self.done.append((name, row["finalname"], entry))
+                if len(self.done) >= REGISTRY_BATCH:
+                    self.flushnow.set()
+
+    async def flusher(self):
+        import asyncio
+        while True:
+            try:
+                await asyncio.wait_for(self.flushnow.wait(), WATCH_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flushnow.clear()
+            await self.flush()
+
+    async def flush(self):
+        # Add what was archived to the registry, then remove the originals and their place in the queue
+        if not self.done:
+            return
+        done, self.done = self.done, []
+        with measure("registry"):
+            db = getdb()
+            with db:
+                writeentries(db, {finalname: entry for _, finalname, entry in done})
+                db.executemany("UPDATE ingest SET state = 'archived' WHERE name = ?", [(name,) for name, *_ in done])
+        await self.removearchived()
+        self.dispatched.difference_update(name for name, *_ in done)
+
+    async def removearchived(self):
+        # Originals of archived entries are removed unless something new has been put in their place.
+        # Also finishes off what the last run archived but didn't get to remove.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        rows = getdb().execute("SELECT * FROM ingest WHERE state = 'archived'").fetchall()
+        await loop.run_in_executor(None, removeoriginals, rows)
+        with measure("registry"):
+            with getdb() as db:
+                db.executemany("DELETE FROM ingest WHERE name = ?", [(row["name"],) for row in rows])
+
+
+def removeoriginals(rows):
+    for row in rows:
+        path = os.path.join(IMPORT_DIR, row["name"])
+        try:
+            if treestate(path) == (row["size"], row["mtime"]):
+                removesource(path)
+        except FileNotFoundError:
+            pass
+
+
+def watch(method="gzip", jobs=None, dedup=False, indexed=False, settle=WATCH_SETTLE, interval=WATCH_INTERVAL):
+    # Archive whatever is dropped into the import folder until interrupted
+    updatereg()
+    getvaultkey()
+    import asyncio
+    asyncio.run(Watcher(method, jobs, dedup, indexed, settle, interval).run())
+    return 0
+
+
+# Archivers still in use, which all have to be for the same root
+archivers = weakref.WeakSet()
+
+
+class Archiver:
+    # The library's way in: a vault with its folders, keyring and registry under `root`.
+    # Nothing is created on disk, and gnupg isn't imported, until something needs it. Settings are module-wide,
+    # like the paths, so a process works with one vault at a time: making an Archiver for another root while one
+    # is still in use raises ValueError. Batch methods return how many entries failed.
+    def __init__(self, root=".", compress_jobs=None, buffer_size=None, stats=None):
+        self.root = os.path.realpath(root)
+        for other in archivers:
+            if other.root != self.root:
+                raise ValueError("An Archiver for " + other.root + " is still in use, and a process can only work "
+                                 "with one vault at a time")
+        archivers.add(self)
+        setpaths(root)
+        if compress_jobs is not None:
+            setcompressjobs(max(compress_jobs, 1))
+        if buffer_size is not None:
+            setbuffersize(buffer_size)
+        if stats is not None:
+            setstats(stats)
+
+    @property
+    def gpg(self):
+        return getgpg()
+
+    @property
+    def registry(self):
+        # This thread's connection to the registry database
+        return getdb()
+
+    def entries(self):
+        # Registry records by entry name
+        return {row["name"]: rowtoentry(row) for row in self.registry.execute("SELECT * FROM entries")}
+
+    def archive(self, names=None, method="gzip", jobs=None, processes=False, dedup=False, indexed=False,
+                incremental=False, segmented=False):
+        # Archive files and folders from the import folder, all of them if `names` is None
+        makedirs()
+        paths = list(Path(IMPORT_DIR).glob("*")) if names is None else [Path(IMPORT_DIR) / name for name in names]
+        missing = [path.name for path in paths if not path.exists()]
+        if missing:
+            raise FileNotFoundError("not in the `import` folder: " + ", ".join(missing))
+        return archivebatch(paths, method, jobs, processes, dedup, indexed, incremental, segmented)
+
+    def restore(self, names=None, jobs=None, processes=False):
+        # Restore entries into the out folder and remove them from the vault, all of them if `names` is None
+        if names is None:
+            names = list(self.entries())
+        return restorebatch(names, jobs, processes)
+
+    def verify(self, names=None, jobs=None, processes=True):
+        return verifybatch(names, jobs, processes)
+
+    def watch(self, method="gzip", jobs=None, dedup=False, indexed=False, settle=WATCH_SETTLE, interval=WATCH_INTERVAL):
+        return watch(method, jobs, dedup, indexed, settle, interval)
+
+    def generations(self, name):
+        # (number, mtime) of each generation of an incremental entry
+        entry = self.indexed(name)[0]
+        if entry["layout"] != "incremental":
+            raise ValueError(name + " has no generations")
+        datapath = Path(VAULT_DIR) / name
+        return [(number, os.path.getmtime(datapath / str(number))) for number in generations(datapath)]
+
+    def list(self, name, generation=None):
+        # Index records of everything in an indexed entry, or a generation of an incremental one
+        entry, datapath = self.indexed(name, generation)
+        with IndexedArchive(datapath, codecmethod(entry["method"])) as archive_in:
+            return archive_in.files
+
+    def extract(self, name, patterns=None, generation=None):
+        # Restore what matches `patterns` (everything by default) from an indexed or incremental entry into the
+        # out folder, keeping the entry. Returns the records of what was restored.
+        entry = self.indexed(name, generation)[0]
+        with Operation("extract", name) as op:
+            records = restoreindexed(name, entry["ext"], codecmethod(entry["method"]), patterns, generation)
+            op.bytes_out = sum(record.get("size", 0) for record in records)
+        return records
+
+    def indexed(self, name, generation=None):
+        # Registry record of an indexed or incremental entry, and the path of its archive (of `generation`, or the
+        # latest one, for an incremental entry)
+        entry = getentry(name)
+        if entry is None or entry.get("layout") not in ("indexed", "incremental"):
+            raise ValueError(name + " is not an indexed or incremental entry in the registry")
+        datapath = Path(VAULT_DIR) / name
+        if entry["layout"] == "indexed":
+            if generation is not None:
+                raise ValueError(name + " has no generations")
+            return entry, datapath
+        existing = generations(datapath)
+        if generation is not None and generation not in existing:
+            raise ValueError(name + " has no generation " + str(generation))
+        return entry, datapath / str(generation or existing[-1])